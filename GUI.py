@@ -2,22 +2,28 @@ import os
 import sys
 import requests
 import hashlib
-import statistics
-from datetime import datetime
+import math
+import numpy as np
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QPushButton, QVBoxLayout,
     QLabel, QLineEdit, QListWidget, QMessageBox,
-    QComboBox, QSplitter, QCheckBox, QHBoxLayout
+    QComboBox, QSplitter, QCheckBox, QHBoxLayout, QDateTimeEdit
 )
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QTimer, QDateTime
 from PySide6.QtGui import QPalette, QColor
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.dates as mdates
 import psycopg2
 from config import get_db_conn
+from Metrics import METRIC_FIELDS
+from rollups import ROLLUP_TABLES, ensure_rollup_tables
+from schema import metrics_table_exists, metrics_needs_migration, ensure_metrics_table, ensure_notifications_table
+from archive import get_archive_reader
 from NotificationGUI import NotificationSettingsDialog
+from gui_workers import TaskRunner
 from PySide6.QtWidgets import QFormLayout, QDialog, QDialogButtonBox
 from dotenv import set_key, load_dotenv
 from pathlib import Path
@@ -40,6 +46,7 @@ def resolve_final_url(input_url):
 
 
 def initialize_databases():
+    # Returns False when the database still has the old metrics layout, which only the server migrates
     conn = get_db_conn()
     cursor = conn.cursor()
 
@@ -87,38 +94,17 @@ def initialize_databases():
         cursor.execute("INSERT INTO users (username, password_hash, role) VALUES (%s, %s, 'owner')",
                        ('owner', hash_password('ownerpass')))
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS metrics (
-            id SERIAL PRIMARY KEY,
-            url TEXT,
-            load_time REAL,
-            memory_usage REAL,
-            cpu_time REAL,
-            dom_nodes INTEGER,
-            total_page_size REAL,
-            fcp REAL,
-            network_requests INTEGER,
-            script_size REAL,
-            broken_links TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            browser_id INTEGER,
-            is_up INTEGER,
-            group_id INTEGER
-        );
-    ''')
+    # Migrating an existing metrics table is the server's job; a fresh install has nothing to convert
+    if not metrics_table_exists(cursor):
+        ensure_metrics_table(cursor)
+    elif metrics_needs_migration(cursor):
+        conn.commit()
+        conn.close()
+        return False
+    # Charts over longer ranges read the hourly and daily rollups
+    ensure_rollup_tables(cursor)
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notifications (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER REFERENCES users(id),
-            url_id INTEGER REFERENCES urls(id),
-            metric TEXT,
-            type TEXT CHECK(type IN ('hard_cap', 'percent_cap', 'on_down', 'on_broken_link')),
-            threshold REAL,
-            last_value REAL,
-            email TEXT
-        );
-    ''')
+    ensure_notifications_table(cursor)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS server_info (
             id SERIAL PRIMARY KEY,
@@ -128,6 +114,302 @@ def initialize_databases():
 
     conn.commit()
     conn.close()
+    return True
+
+
+# Data access for the Dashboard. These run on TaskRunner pool threads and must not touch widgets.
+def execute_statements(*statements):
+    # (query, params) pairs in one transaction
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        for query, params in statements:
+            cursor.execute(query, params)
+        conn.commit()
+
+
+def fetch_users():
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username, role FROM users")
+        return cursor.fetchall()
+
+
+def fetch_url_rows(role, user_id):
+    # Current state per URL from latest_metrics: down if any browser's newest result was down
+    current = '''
+        LEFT JOIN (
+            SELECT url_id, MIN(is_up) FILTER (WHERE is_up >= 0) AS is_up, MAX(broken_link_count) AS broken
+            FROM latest_metrics GROUP BY url_id
+        ) lm ON lm.url_id = u.id
+    '''
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        if role in ("admin", "owner"):
+            cursor.execute(f'''
+                SELECT u.id, u.url, u.last_checked, u.forceInactive, u.referenced, lm.is_up, lm.broken
+                FROM urls u
+                {current}
+            ''')
+        else:
+            cursor.execute(f'''
+                SELECT uu.url_id, uu.url_nick, u.last_checked, lm.is_up, lm.broken
+                FROM user_urls uu
+                JOIN urls u ON uu.url_id = u.id
+                {current}
+                WHERE uu.user_id = %s
+            ''', (user_id,))
+        return cursor.fetchall()
+
+
+CHART_METRICS = (*METRIC_FIELDS, "is_up")
+BROWSER_IDS = {"chrome": 1, "edge": 2, "opera": 3}
+# EXTRACT(EPOCH FROM timestamp) counts naive timestamps from this, whatever the local time zone
+EPOCH = datetime(1970, 1, 1)
+CHART_RANGES = (
+    ("Last 24 hours", timedelta(hours=24)),
+    ("Last 7 days", timedelta(days=7)),
+    ("Last 30 days", timedelta(days=30)),
+    ("All time", None),
+    ("Custom", "custom"),
+)
+# Open-ended charts poll for rows newer than the last one they hold
+CHART_REFRESH_SECONDS = 30
+
+
+def chart_source(start, end, buckets):
+    # Raw rows while a chart bucket spans less than an hour; past that the rollups hold fewer rows per bucket
+    bucket_seconds = (end - start).total_seconds() / buckets
+    if bucket_seconds >= 86400:
+        return "day"
+    if bucket_seconds >= 3600:
+        return "hour"
+    return None
+
+
+def chart_sql(metric, unit, group_id):
+    # One row per chart bucket: the min and max point with their timestamps (so spikes survive), plus
+    # count, sum and sum of squares for the range statistics. Only `metric` and its timestamp are read.
+    # The rollup bucket holding `start` begins before it, so it is counted into the first chart bucket.
+    group_filter = "AND group_id = %(group_id)s" if group_id is not None else ""
+    if unit is None:
+        points = f"""
+            SELECT timestamp AS ts, {metric}::float8 AS lo, {metric}::float8 AS hi,
+                   1 AS n, {metric}::float8 AS total, {metric}::float8 * {metric} AS total_sq
+            FROM metrics
+            WHERE url_id = %(url_id)s AND browser_id = ANY(%(browsers)s) {group_filter}
+              AND timestamp >= %(start)s AND timestamp < %(end)s AND {metric} >= 0
+        """
+    else:
+        points = f"""
+            SELECT bucket AS ts, min AS lo, max AS hi, count AS n, sum AS total, sum_sq AS total_sq
+            FROM {ROLLUP_TABLES[unit]}
+            WHERE url_id = %(url_id)s AND browser_id = ANY(%(browsers)s) {group_filter}
+              AND metric = %(metric)s AND bucket >= date_trunc('{unit}', %(start)s::timestamp) AND bucket < %(end)s
+        """
+    return f"""
+        SELECT (array_agg(ts ORDER BY lo, ts))[1], MIN(lo), (array_agg(ts ORDER BY hi DESC, ts))[1], MAX(hi),
+               SUM(n), SUM(total), SUM(total_sq), COUNT(total_sq) = COUNT(*)
+        FROM (
+            SELECT *, GREATEST(width_bucket(EXTRACT(EPOCH FROM ts), %(lo)s, %(hi)s, %(buckets)s), 1) AS b
+            FROM ({points}) AS p
+        ) AS p
+        GROUP BY b
+        ORDER BY b
+    """
+
+
+def downsample_archive(timestamps, values, start, end, buckets):
+    # The same per-bucket rows as chart_sql, for archived columns
+    keep = ~np.isnan(values) & (values >= 0)
+    timestamps, values = timestamps[keep], values[keep].astype(float)
+    if not len(values):
+        return []
+    seconds = (timestamps - np.datetime64(start, "s")).astype(float)
+    span = max((end - start).total_seconds(), 1.0)
+    bucket = np.clip((seconds / span * buckets).astype(int), 0, buckets - 1)
+    order = np.lexsort((values, bucket))
+    bucket, timestamps, values = bucket[order], timestamps[order], values[order]
+    firsts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    lasts = np.r_[firsts[1:] - 1, len(bucket) - 1]
+    counts = np.bincount(bucket)[bucket[firsts]]
+    totals = np.bincount(bucket, values)[bucket[firsts]]
+    squares = np.bincount(bucket, values * values)[bucket[firsts]]
+    return list(zip(timestamps[firsts].tolist(), values[firsts].tolist(), timestamps[lasts].tolist(),
+                    values[lasts].tolist(), counts.tolist(), totals.tolist(), squares.tolist(),
+                    [True] * len(firsts)))
+
+
+def fetch_chart(url_id, browser_ids, group_id, metric, start, end, buckets):
+    # Downsampled series of one metric over [start, end): bucket rows for chart_points, from raw rows,
+    # rollups or archive files depending on the range, and the newest raw timestamp they cover.
+    # start=None means from the first measurement, end=None up to now.
+    if metric not in CHART_METRICS:
+        raise ValueError(f"unknown metric {metric!r}")
+    end = end or datetime.now()
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(timestamp) FROM metrics WHERE url_id = %s", (url_id,))
+        oldest = cursor.fetchone()[0]
+        # Ranges that retention moved out of the database are read from the archive files instead
+        archived = None
+        archive = get_archive_reader()
+        if archive.parts and (start is None or oldest is None or start < oldest):
+            archived = archive.series(url_id, browser_ids, group_id, start, oldest)
+            if not len(archived["timestamp"]):
+                archived = None
+        if start is None:
+            firsts = [oldest] if oldest is not None else []
+            if archived is not None:
+                firsts.append(archived["timestamp"][0].tolist())
+            if not firsts:
+                return [], None
+            start = min(firsts)
+        if start >= end:
+            return [], None
+
+        rows = []
+        if archived is not None:
+            rows += downsample_archive(archived["timestamp"], archived[metric], start, end, buckets)
+        if oldest is not None and oldest < end:
+            cursor.execute(chart_sql(metric, chart_source(start, end, buckets), group_id), {
+                "url_id": url_id, "browsers": list(browser_ids), "group_id": group_id, "metric": metric,
+                "start": max(start, oldest), "end": end, "buckets": buckets,
+                "lo": (start - EPOCH).total_seconds(), "hi": (end - EPOCH).total_seconds(),
+            })
+            rows += cursor.fetchall()
+        latest = None
+        if rows:
+            # Rollup rows carry bucket starts, so where incremental refreshes resume is read from the raw rows
+            group_filter = "AND group_id = %s" if group_id is not None else ""
+            cursor.execute(f"""
+                SELECT MAX(timestamp) FROM metrics
+                WHERE url_id = %s AND browser_id = ANY(%s) {group_filter} AND timestamp < %s
+            """, [url_id, list(browser_ids), *([group_id] if group_id is not None else []), end])
+            latest = cursor.fetchone()[0]
+    return rows, latest
+
+
+def fetch_chart_tail(url_id, browser_ids, group_id, metric, after, before=None):
+    # Raw (timestamp, value) rows newer than `after` (and older than `before`, for a custom range that ends
+    # in the future), as one-point bucket rows to append to a chart
+    if metric not in CHART_METRICS:
+        raise ValueError(f"unknown metric {metric!r}")
+    group_filter = "AND group_id = %s" if group_id is not None else ""
+    end_filter = "AND timestamp < %s" if before is not None else ""
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT timestamp, {metric}::float8 FROM metrics
+            WHERE url_id = %s AND browser_id = ANY(%s) {group_filter} AND timestamp > %s {end_filter} AND {metric} >= 0
+            ORDER BY timestamp
+        """, [url_id, list(browser_ids), *([group_id] if group_id is not None else []), after,
+              *([before] if before is not None else [])])
+        return [(ts, value, ts, value, 1, value, value * value, True) for ts, value in cursor.fetchall()]
+
+
+def chart_points(rows):
+    # Bucket rows -> (timestamps, values, (count, mean, std or None)) with each bucket's min and max in time order
+    timestamps, values = [], []
+    count, total, total_sq, complete = 0, 0.0, 0.0, True
+    for min_ts, lo, max_ts, hi, n, bucket_total, bucket_sq, bucket_complete in rows:
+        for ts, value in sorted({(min_ts, lo), (max_ts, hi)}):
+            timestamps.append(ts)
+            values.append(value)
+        count += n
+        total += bucket_total
+        if bucket_complete:
+            total_sq += bucket_sq
+        complete = complete and bucket_complete
+    if not count:
+        return timestamps, values, None
+    mean = total / count
+    std = math.sqrt(max(total_sq - total * mean, 0.0) / (count - 1)) if count > 1 else 0.0
+    return timestamps, values, (count, mean, std if complete else None)
+
+
+def fetch_group_filter():
+    # Groups that have measurements; latest_metrics has a row for every series ever written
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT cg.id, cg.name
+            FROM client_groups cg
+            JOIN latest_metrics m ON m.group_id = cg.id
+        """)
+        return cursor.fetchall()
+
+
+def fetch_group_list():
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM client_groups ORDER BY name")
+        return cursor.fetchall()
+
+
+def follow_url(user_id, url_nick):
+    # Returns "unresolved", "nick_taken", "already_following" or "added"
+    url = resolve_final_url(url_nick)
+    if not url:
+        return "unresolved"
+
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+
+        # Check if user already used this nickname
+        cursor.execute("""
+            SELECT 1 FROM user_urls WHERE user_id = %s AND url_nick = %s
+        """, (user_id, url_nick))
+        if cursor.fetchone():
+            return "nick_taken"
+
+        # Check if normalized URL exists in urls table
+        cursor.execute("SELECT id FROM urls WHERE url = %s", (url,))
+        url_row = cursor.fetchone()
+
+        if url_row:
+            url_id = url_row[0]
+            # Check if user already added this exact URL
+            cursor.execute("""
+                SELECT 1 FROM user_urls WHERE user_id = %s AND url_id = %s
+            """, (user_id, url_id))
+            if cursor.fetchone():
+                return "already_following"
+            # Update reference count
+            cursor.execute("UPDATE urls SET referenced = referenced + 1 WHERE id = %s", (url_id,))
+        else:
+            # Insert new URL
+            cursor.execute("INSERT INTO urls (url, referenced, forceInactive) VALUES (%s, 1, 0) RETURNING id", (url,))
+            url_id = cursor.fetchone()[0]
+
+        # Associate with user
+        cursor.execute("INSERT INTO user_urls (user_id, url_id, url_nick) VALUES (%s, %s, %s)",
+                       (user_id, url_id, url_nick))
+        conn.commit()
+    return "added"
+
+
+def create_client_group(name):
+    # False if the name is taken
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM client_groups WHERE name = %s", (name,))
+        if cursor.fetchone():
+            return False
+        cursor.execute("INSERT INTO client_groups (name) VALUES (%s)", (name,))
+        conn.commit()
+    return True
+
+
+def delete_client_group(group_id):
+    # False if a node is still assigned to the group
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM node_role WHERE group_id = %s", (group_id,))
+        if cursor.fetchone()[0] > 0:
+            return False
+        cursor.execute("DELETE FROM client_groups WHERE id = %s", (group_id,))
+        conn.commit()
+    return True
 
 
 class Dashboard(QWidget):
@@ -138,7 +420,10 @@ class Dashboard(QWidget):
         self.logout_callback = logout_callback
         self.setWindowTitle("Dashboard")
 
-        self.metric_data = {}
+        self.timestamps = []
+        self.values = []
+        self.chart = None  # what is drawn: the request, its bucket rows and the newest raw timestamp
+        self.tasks = TaskRunner(parent=self)
 
         self.url_input = QLineEdit()
         self.url_input.setPlaceholderText("Enter URL")
@@ -176,7 +461,8 @@ class Dashboard(QWidget):
         self.add_btn.clicked.connect(self.add_url)
         self.search_input.textChanged.connect(self.filter_urls)
         self.url_list.itemSelectionChanged.connect(self.update_metrics)
-        self.metric_dropdown.currentTextChanged.connect(self.update_plot)
+        self.metric_dropdown.addItems(list(CHART_METRICS))
+        self.metric_dropdown.currentTextChanged.connect(self.update_metrics)
 
         left_layout = QVBoxLayout()
         left_layout.addWidget(QLabel("Add or Select URL"))
@@ -193,8 +479,35 @@ class Dashboard(QWidget):
         left_layout.addWidget(self.notifications_btn)
 
         right_layout = QVBoxLayout()
+        self.loading_label = QLabel("")
+        self.loading_label.setStyleSheet("color: lightgray")
+        self.tasks.pending_changed.connect(
+            lambda pending: self.loading_label.setText("Loading..." if pending else ""))
+        right_layout.addWidget(self.loading_label)
         right_layout.addWidget(QLabel("Select Metric to View"))
         right_layout.addWidget(self.metric_dropdown)
+
+        self.range_dropdown = QComboBox()
+        for label, span in CHART_RANGES:
+            self.range_dropdown.addItem(label, span)
+        self.range_start = QDateTimeEdit(QDateTime.currentDateTime().addDays(-7))
+        self.range_end = QDateTimeEdit(QDateTime.currentDateTime())
+        range_layout = QHBoxLayout()
+        range_layout.addWidget(QLabel("Time Range"))
+        range_layout.addWidget(self.range_dropdown)
+        for label, edit in (("From", self.range_start), ("To", self.range_end)):
+            edit.setCalendarPopup(True)
+            edit.setDisplayFormat("yyyy-MM-dd HH:mm")
+            edit.setVisible(False)
+            edit.editingFinished.connect(self.update_metrics)
+            range_layout.addWidget(edit)
+        self.range_dropdown.currentIndexChanged.connect(self.change_range)
+        right_layout.addLayout(range_layout)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(CHART_REFRESH_SECONDS * 1000)
+        self.refresh_timer.timeout.connect(self.refresh_chart)
+        self.refresh_timer.start()
         self.hover_label = QLabel("")
         self.hover_label.setStyleSheet("color: lightgreen")
         right_layout.addWidget(self.canvas)
@@ -291,16 +604,17 @@ class Dashboard(QWidget):
 
         self.refresh_urls()
 
+    def show_task_error(self, message):
+        QMessageBox.critical(self, "Database Error", message)
+
     def load_users(self):
+        self.tasks.submit("users", fetch_users, on_done=self.show_users, on_error=self.show_task_error)
+
+    def show_users(self, users):
         self.user_items = []
-        self.user_list.clear()
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username, role FROM users")
-        for uid, name, role in cursor.fetchall():
+        for uid, name, role in users:
             entry = f"{uid} | {name} | {role}"
             self.user_items.append((entry.lower(), entry))
-        conn.close()
         self.filter_users()
 
     def filter_users(self):
@@ -321,13 +635,14 @@ class Dashboard(QWidget):
         if role == "owner":
             QMessageBox.warning(self, "Invalid", "Cannot change role of owner.")
             return
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET role = 'admin' WHERE id = %s", (user_id,))
-        conn.commit()
-        conn.close()
-        self.load_users()
-        QMessageBox.information(self, "Promoted", f"{username} is now an admin.")
+
+        def promoted(_):
+            self.load_users()
+            QMessageBox.information(self, "Promoted", f"{username} is now an admin.")
+
+        self.tasks.submit("user_role", execute_statements,
+                          ("UPDATE users SET role = 'admin' WHERE id = %s", (user_id,)),
+                          on_done=promoted, on_error=self.show_task_error)
 
     def demote_user(self):
         selected = self.user_list.currentItem()
@@ -340,41 +655,41 @@ class Dashboard(QWidget):
         if role == "owner":
             QMessageBox.warning(self, "Invalid", "Cannot demote the owner.")
             return
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET role = 'user' WHERE id = %s", (user_id,))
-        conn.commit()
-        conn.close()
-        self.load_users()
-        QMessageBox.information(self, "Demoted", f"{username} is now a user.")
+
+        def demoted(_):
+            self.load_users()
+            QMessageBox.information(self, "Demoted", f"{username} is now a user.")
+
+        self.tasks.submit("user_role", execute_statements,
+                          ("UPDATE users SET role = 'user' WHERE id = %s", (user_id,)),
+                          on_done=demoted, on_error=self.show_task_error)
 
     def refresh_urls(self):
+        self.tasks.submit("urls", fetch_url_rows, self.role, self.user_id,
+                          on_done=self.show_urls, on_error=self.show_task_error)
+
+    def show_urls(self, rows):
         self.url_items = []
-        self.url_list.clear()
-        conn = get_db_conn()
-        cursor = conn.cursor()
         if self.role in ("admin", "owner"):
-            cursor.execute('''
-                SELECT u.id, u.url, u.last_checked, u.forceInactive, u.referenced
-                FROM urls u
-            ''')
-            for url_id, url, checked, inactive, referenced in cursor.fetchall():
+            for url_id, url, checked, inactive, referenced, is_up, broken in rows:
                 status = "Inactive" if inactive else "Active"
-                text = f"{url_id} | {url} (Last checked: {checked}, Status: {status}, Referenced: {referenced})"
+                text = (f"{url_id} | {url} (Last checked: {checked}, Status: {status}, Referenced: {referenced}, "
+                        f"{self.current_state_text(is_up, broken)})")
                 self.url_items.append((text.lower(), text))
         else:
-            cursor.execute('''
-                SELECT uu.url_id, uu.url_nick, u.last_checked
-                FROM user_urls uu
-                JOIN urls u ON uu.url_id = u.id
-                WHERE uu.user_id = %s
-            ''', (self.user_id,))
-            for url_id, nick, checked in cursor.fetchall():
-                text = f"{url_id} | {nick} (Last checked: {checked})"
+            for url_id, nick, checked, is_up, broken in rows:
+                text = f"{url_id} | {nick} (Last checked: {checked}, {self.current_state_text(is_up, broken)})"
                 self.url_items.append((text.lower(), text))
         self.filter_urls()
-        conn.close()
 
+    @staticmethod
+    def current_state_text(is_up, broken):
+        if is_up is None:
+            return "Now: no data"
+        text = "Now: Up" if is_up > 0 else "Now: Down"
+        if broken and broken > 0:
+            text += f", {broken} broken link(s)"
+        return text
 
     def filter_urls(self):
         search_term = self.search_input.text().lower()
@@ -385,125 +700,157 @@ class Dashboard(QWidget):
 
     def add_url(self):
         url_nick = self.url_input.text().strip()
-        if not url_nick:
-            return
-        url = resolve_final_url(url_nick)
-        if not url:
-            QMessageBox.warning(self, "Error", "Could not resolve URL.")
+        if not url_nick or self.tasks.is_pending("add_url"):
             return
+        # Resolving the URL can take the full request timeout
+        self.add_btn.setEnabled(False)
+        self.add_btn.setText("Adding...")
+
+        def finished():
+            self.add_btn.setEnabled(True)
+            self.add_btn.setText("Add URL")
+
+        def added(outcome):
+            finished()
+            if outcome == "unresolved":
+                QMessageBox.warning(self, "Error", "Could not resolve URL.")
+            elif outcome == "nick_taken":
+                QMessageBox.information(self, "Already Added", "You are already following this url.")
+            elif outcome == "already_following":
+                QMessageBox.information(self, "Already Added", "This URL is already in your list.")
+            else:
+                self.url_input.clear()
+                self.refresh_urls()
 
-        conn = get_db_conn()
-        cursor = conn.cursor()
-
-        # Check if user already used this nickname
-        cursor.execute("""
-            SELECT 1 FROM user_urls WHERE user_id = %s AND url_nick = %s
-        """, (self.user_id, url_nick))
-        if cursor.fetchone():
-            QMessageBox.information(self, "Already Added", "You are already following this url.")
-            conn.close()
-            return
+        def failed(message):
+            finished()
+            self.show_task_error(message)
 
-        # Check if normalized URL exists in urls table
-        cursor.execute("SELECT id FROM urls WHERE url = %s", (url,))
-        url_row = cursor.fetchone()
+        self.tasks.submit("add_url", follow_url, self.user_id, url_nick, on_done=added, on_error=failed)
 
-        if url_row:
-            url_id = url_row[0]
-            # Check if user already added this exact URL
-            cursor.execute("""
-                SELECT 1 FROM user_urls WHERE user_id = %s AND url_id = %s
-            """, (self.user_id, url_id))
-            if cursor.fetchone():
-                QMessageBox.information(self, "Already Added", "This URL is already in your list.")
-                conn.close()
-                return
-            # Update reference count
-            cursor.execute("UPDATE urls SET referenced = referenced + 1 WHERE id = %s", (url_id,))
-        else:
-            # Insert new URL
-            cursor.execute("INSERT INTO urls (url, referenced, forceInactive) VALUES (%s, 1, 0)", (url,))
-            conn.commit()
-            cursor.execute("SELECT id FROM urls WHERE url = %s", (url,))
-            url_id = cursor.fetchone()[0]
+    def clear_chart(self, message):
+        self.chart = None
+        self.timestamps = []
+        self.values = []
+        self.line = None
+        self.ax.clear()
+        self.canvas.draw()
+        self.stats_label.setText(message)
 
-        # Associate with user
-        cursor.execute("INSERT INTO user_urls (user_id, url_id, url_nick) VALUES (%s, %s, %s)",
-                       (self.user_id, url_id, url_nick))
-        conn.commit()
-        conn.close()
-        self.url_input.clear()
-        self.refresh_urls()
+    def update_metric_choices(self, browser_ids):
+        # Opera doesn't report fcp
+        metrics = [name for name in CHART_METRICS if not (name == "fcp" and 3 in browser_ids)]
+        current = self.metric_dropdown.currentText()
+        if metrics == [self.metric_dropdown.itemText(i) for i in range(self.metric_dropdown.count())]:
+            return
+        self.metric_dropdown.blockSignals(True)
+        self.metric_dropdown.clear()
+        self.metric_dropdown.addItems(metrics)
+        if current in metrics:
+            self.metric_dropdown.setCurrentText(current)
+        self.metric_dropdown.blockSignals(False)
 
     def update_metrics(self):
         selected = self.url_list.currentItem()
         if not selected:
             return
         url_id = int(selected.text().split("|")[0].strip())
-        conn_urls = get_db_conn()
-        cursor_urls = conn_urls.cursor()
-        cursor_urls.execute("SELECT url FROM urls WHERE id=%s", (url_id,))
-        row = cursor_urls.fetchone()
-        conn_urls.close()
-        if not row:
-            return
-        url = row[0]
-        conn_metrics = get_db_conn()
-        cursor = conn_metrics.cursor()
-        browser_map = {"chrome": 1, "edge": 2, "opera": 3}
-        selected_browser_ids = [browser_map[name] for name, cb in self.browser_checkboxes.items() if cb.isChecked()]
+        selected_browser_ids = [BROWSER_IDS[name] for name, cb in self.browser_checkboxes.items() if cb.isChecked()]
         if not selected_browser_ids:
-            self.metric_dropdown.clear()
-            self.ax.clear()
-            self.canvas.draw()
-            self.stats_label.setText("No browsers selected.")
+            self.tasks.cancel("metrics")
+            self.clear_chart("No browsers selected.")
             return
+        self.update_metric_choices(selected_browser_ids)
+        start, end, span = self.chart_range()
+        if end is not None and start >= end:
+            self.clear_chart("The range ends before it starts.")
+            return
+        chart = {
+            "url_id": url_id, "browser_ids": selected_browser_ids, "group_id": self.group_filter.currentData(),
+            "metric": self.metric_dropdown.currentText(), "start": start, "end": end, "span": span,
+            # Two points per bucket, so about one per pixel of chart width
+            "buckets": max(self.canvas.width() // 2, 50),
+        }
 
-        placeholders = ','.join(['%s'] * len(selected_browser_ids))
-        cursor.execute(f"SELECT * FROM metrics WHERE url = %s AND browser_id IN ({placeholders}) ORDER BY timestamp",
-                       (url, *selected_browser_ids))
+        # A newer selection replaces any load still in flight
+        self.tasks.cancel("metrics_tail")
+        self.stats_label.setText("<span style='color:white;'>Loading metrics...</span>")
+        self.tasks.submit(
+            "metrics", fetch_chart, chart["url_id"], chart["browser_ids"], chart["group_id"], chart["metric"],
+            start, end, chart["buckets"],
+            on_done=lambda result: self.show_chart(chart, *result),
+            on_error=lambda message: self.clear_chart(f"Could not load metrics: {message}")
+        )
 
-        rows = cursor.fetchall()
-        if not rows:
-            self.metric_dropdown.clear()
-            self.ax.clear()
-            self.canvas.draw()
-            self.stats_label.setText("No data available.")
+    def chart_range(self):
+        # (start, end, span): end is None for ranges that run up to now, span for ones that also slide
+        span = self.range_dropdown.currentData()
+        if span == "custom":
+            return self.range_start.dateTime().toPython(), self.range_end.dateTime().toPython(), None
+        if span is None:
+            return None, None, None
+        return datetime.now() - span, None, span
+
+    def change_range(self):
+        custom = self.range_dropdown.currentData() == "custom"
+        self.range_start.setVisible(custom)
+        self.range_end.setVisible(custom)
+        self.update_metrics()
+
+    def refresh_chart(self):
+        # Appends rows written since the last load instead of reloading the range. Open-ended ranges and
+        # custom ranges that end in the future keep polling; a range that has ended cannot change.
+        chart = self.chart
+        if chart is None or self.tasks.is_pending("metrics") or self.tasks.is_pending("metrics_tail"):
             return
-        column_names = [description[0] for description in cursor.description]
-        hide_fcp = 3 in selected_browser_ids
-
-        metric_cols = [
-            'load_time', 'memory_usage', 'cpu_time', 'dom_nodes',
-            'total_page_size', 'fcp', 'network_requests',
-            'script_size', 'timestamp', 'is_up'
-        ]
-        if hide_fcp:
-            metric_cols.remove("fcp")
-
-        selected_gid = self.group_filter.currentData()
-        if selected_gid is not None:
-            cursor.execute(
-                f"SELECT * FROM metrics WHERE url = %s AND browser_id IN ({placeholders}) AND group_id = %s ORDER BY timestamp",
-                (url, *selected_browser_ids, selected_gid))
-        else:
-            cursor.execute(f"SELECT * FROM metrics WHERE url = %s AND browser_id IN ({placeholders}) ORDER BY timestamp",
-                           (url, *selected_browser_ids))
-
-        self.metric_data = {col: [] for col in column_names if col in metric_cols}
-        for row in rows:
-            for i, name in enumerate(column_names):
-                if name in self.metric_data:
-                    self.metric_data[name].append(row[i])
-        self.metric_dropdown.clear()
-        self.metric_dropdown.addItems([key for key in self.metric_data if key != 'timestamp'])
-        self.update_plot(self.metric_dropdown.currentText())
-        conn_metrics.close()
+        if chart["end"] is not None and chart["end"] <= datetime.now():
+            return
+        after = chart["latest"] or chart["start"] or EPOCH
+        self.tasks.submit(
+            "metrics_tail", fetch_chart_tail, chart["url_id"], chart["browser_ids"], chart["group_id"],
+            chart["metric"], after, chart["end"],
+            on_done=lambda rows: self.append_chart(chart, rows)
+        )
 
-    def update_plot(self, metric_name):
-        if not self.metric_data or metric_name not in self.metric_data:
+    def append_chart(self, chart, rows):
+        if chart is not self.chart:
+            return
+        if chart["span"] is not None:
+            # Sliding ranges drop the buckets that fell out of the window
+            cutoff = datetime.now() - chart["span"]
+            chart["rows"] = [row for row in chart["rows"] if max(row[0], row[2]) >= cutoff]
+        if rows:
+            chart["rows"] += rows
+            chart["latest"] = rows[-1][0]
+            if len(chart["rows"]) > 2 * chart["buckets"]:
+                # Appended raw points have outgrown the pixel budget; rebucket the range
+                self.update_metrics()
+                return
+        elif chart["span"] is None:
             return
+        self.show_chart(chart, chart["rows"], chart["latest"])
+
+    def show_chart(self, chart, rows, latest):
+        timestamps, values, stats = chart_points(rows)
+        if not timestamps:
+            self.clear_chart("No data available.")
+            # Keep polling an open-ended range so the first measurement shows up
+            chart.update(rows=[], latest=latest)
+            self.chart = chart
+            return
+        chart.update(rows=rows, latest=latest)
+        self.chart = chart
+        self.timestamps = timestamps
+        self.values = values
+        self.update_plot(chart["metric"])
+        count, mean_val, std_val = stats
+        self.stats_label.setText(
+            f"<b style='color: white;'>Mean:</b> {mean_val:.2f}<br><b style='color: white;'>Std Dev:</b> "
+            + (f"{std_val:.2f}" if std_val is not None else "n/a (rebuild rollups)")
+            + f"<br><b style='color: white;'>Samples:</b> {count}"
+        )
 
+    def update_plot(self, metric_name):
         from matplotlib.dates import date2num
 
         self.line = None
@@ -511,14 +858,6 @@ class Dashboard(QWidget):
         self.ax.clear()
         self.annot.set_visible(False)
 
-        # Filter values and corresponding timestamps
-        self.values = [v for v in self.metric_data[metric_name] if isinstance(v, (int, float)) and v != -1]
-        self.timestamps = [
-            ts if isinstance(ts, datetime) else datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-            for v, ts in zip(self.metric_data[metric_name], self.metric_data['timestamp'])
-            if isinstance(v, (int, float)) and v != -1
-        ]
-
         # Convert timestamps to numeric format for matplotlib
         x_vals = [date2num(ts) for ts in self.timestamps]
 
@@ -528,7 +867,7 @@ class Dashboard(QWidget):
             self.values,
             label=metric_name,
             color='cyan',
-            marker='o',
+            marker='o' if len(x_vals) <= 200 else None,  # dense downsampled series read better as a line
             markersize=8,
             picker=5  # Needed for .contains(event)
         )
@@ -546,17 +885,6 @@ class Dashboard(QWidget):
         # Update the canvas
         self.canvas.draw()
 
-        # Show stats if any valid data
-        valid_values = [v for v in self.values if isinstance(v, (int, float))]
-        if valid_values:
-            mean_val = statistics.mean(valid_values)
-            std_val = statistics.stdev(valid_values) if len(valid_values) > 1 else 0
-            self.stats_label.setText(
-                f"<b style='color: white;'>Mean:</b> {mean_val:.2f}<br><b style='color: white;'>Std Dev:</b> {std_val:.2f}"
-            )
-        else:
-            self.stats_label.setText("<span style='color:white;'>No valid data for statistics.</span>")
-
     def hover(self, event):
         if not hasattr(self, 'line') or self.line is None:
             return
@@ -603,24 +931,21 @@ class Dashboard(QWidget):
 
         url_id = int(selected.text().split("|")[0].strip())
 
-        conn = get_db_conn()
-        cursor = conn.cursor()
-
-        # Delete notifications related to this user and this URL
-        cursor.execute("DELETE FROM notifications WHERE user_id = %s AND url_id = %s", (self.user_id, url_id))
-
-        # Remove the URL-user association
-        cursor.execute("DELETE FROM user_urls WHERE user_id = %s AND url_id = %s", (self.user_id, url_id))
-
-        # Update the reference count for the URL
-        cursor.execute("UPDATE urls SET referenced = referenced - 1 WHERE id = %s AND referenced > 0", (url_id,))
-
-        conn.commit()
-        conn.close()
-
-        QMessageBox.information(self, "Unfollowed",
-                                "You are no longer following this URL, and related notifications were deleted.")
-        self.refresh_urls()
+        def unfollowed(_):
+            QMessageBox.information(self, "Unfollowed",
+                                    "You are no longer following this URL, and related notifications were deleted.")
+            self.refresh_urls()
+
+        self.tasks.submit(
+            "unfollow", execute_statements,
+            # Delete notifications related to this user and this URL
+            ("DELETE FROM notifications WHERE user_id = %s AND url_id = %s", (self.user_id, url_id)),
+            # Remove the URL-user association
+            ("DELETE FROM user_urls WHERE user_id = %s AND url_id = %s", (self.user_id, url_id)),
+            # Update the reference count for the URL
+            ("UPDATE urls SET referenced = referenced - 1 WHERE id = %s AND referenced > 0", (url_id,)),
+            on_done=unfollowed, on_error=self.show_task_error
+        )
 
     def deactivate_selected_url(self):
         selected = self.url_list.currentItem()
@@ -629,12 +954,11 @@ class Dashboard(QWidget):
             return
 
         url_id = int(selected.text().split("|")[0].strip())
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE urls SET forceInactive = 1 WHERE id = %s", (url_id,))
-        conn.commit()
-        conn.close()
-        QMessageBox.information(self, "Deactivated", "The selected URL has been deactivated.")
+        self.tasks.submit(
+            "url_state", execute_statements, ("UPDATE urls SET forceInactive = 1 WHERE id = %s", (url_id,)),
+            on_done=lambda _: QMessageBox.information(self, "Deactivated", "The selected URL has been deactivated."),
+            on_error=self.show_task_error
+        )
 
     def reactivate_selected_url(self):
         selected = self.url_list.currentItem()
@@ -643,14 +967,11 @@ class Dashboard(QWidget):
             return
 
         url_id = int(selected.text().split("|")[0].strip())
-
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE urls SET forceInactive = 0 WHERE id = %s", (url_id,))
-        conn.commit()
-        conn.close()
-
-        QMessageBox.information(self, "Reactivated", "The selected URL has been reactivated.")
+        self.tasks.submit(
+            "url_state", execute_statements, ("UPDATE urls SET forceInactive = 0 WHERE id = %s", (url_id,)),
+            on_done=lambda _: QMessageBox.information(self, "Reactivated", "The selected URL has been reactivated."),
+            on_error=self.show_task_error
+        )
 
     def set_as_server(self):
         from security import encrypt
@@ -751,27 +1072,35 @@ class Dashboard(QWidget):
             os.system("start cmd /k python notificationCrawler.py")
 
     def refresh_groups(self):
+        self.tasks.submit("group_filter", fetch_group_filter, on_done=self.show_group_filter,
+                          on_error=self.show_task_error)
+
+    def show_group_filter(self, groups):
+        selected = self.group_filter.currentData()
+        # Repopulating must not trigger a chart reload per item
+        self.group_filter.blockSignals(True)
         self.group_filter.clear()
         self.group_filter.addItem("All Groups", None)
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT DISTINCT cg.id, cg.name
-            FROM client_groups cg
-            JOIN metrics m ON m.group_id = cg.id
-        """)
-        for gid, name in cursor.fetchall():
+        for gid, name in groups:
             self.group_filter.addItem(f"{name} (ID {gid})", gid)
-        conn.close()
+        index = self.group_filter.findData(selected)
+        self.group_filter.setCurrentIndex(max(index, 0))
+        self.group_filter.blockSignals(False)
+        if index < 0:
+            self.update_metrics()
 
     def refresh_group_list(self):
+        self.tasks.submit("group_list", fetch_group_list, on_done=self.show_group_list,
+                          on_error=self.show_task_error)
+
+    def show_group_list(self, groups):
         self.group_list.clear()
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM client_groups ORDER BY name")
-        for gid, name in cursor.fetchall():
+        for gid, name in groups:
             self.group_list.addItem(f"{name} (ID {gid})", gid)
-        conn.close()
+
+    def refresh_all_groups(self):
+        self.refresh_group_list()
+        self.refresh_groups()
 
     def create_group(self):
         name = self.group_create_input.text().strip()
@@ -779,41 +1108,30 @@ class Dashboard(QWidget):
             QMessageBox.warning(self, "Input Error", "Group name cannot be empty.")
             return
 
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        try:
-            # Check if name already exists
-            cursor.execute("SELECT 1 FROM client_groups WHERE name = %s", (name,))
-            if cursor.fetchone():
+        def created(ok):
+            if not ok:
                 QMessageBox.warning(self, "Duplicate Group", "A group with this name already exists.")
                 return
-
-            cursor.execute("INSERT INTO client_groups (name) VALUES (%s)", (name,))
-            conn.commit()
             QMessageBox.information(self, "Success", f"Group '{name}' created successfully.")
             self.group_create_input.clear()
-        except Exception as e:
-            QMessageBox.critical(self, "Database Error", f"Failed to create group:\n{str(e)}")
-        finally:
-            conn.close()
+            self.refresh_all_groups()
 
-        self.refresh_group_list()
-        self.refresh_groups()
+        def failed(message):
+            QMessageBox.critical(self, "Database Error", f"Failed to create group:\n{message}")
+
+        self.tasks.submit("group_change", create_client_group, name, on_done=created, on_error=failed)
 
     def delete_group(self):
         group_id = self.group_list.currentData()
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM node_role WHERE group_id = %s", (group_id,))
-        if cursor.fetchone()[0] > 0:
-            QMessageBox.warning(self, "Error", "Cannot delete group in use.")
-        else:
-            cursor.execute("DELETE FROM client_groups WHERE id = %s", (group_id,))
-            conn.commit()
-            QMessageBox.information(self, "Deleted", "Group deleted.")
-        conn.close()
-        self.refresh_group_list()
-        self.refresh_groups()
+
+        def deleted(ok):
+            if ok:
+                QMessageBox.information(self, "Deleted", "Group deleted.")
+            else:
+                QMessageBox.warning(self, "Error", "Cannot delete group in use.")
+            self.refresh_all_groups()
+
+        self.tasks.submit("group_change", delete_client_group, group_id, on_done=deleted, on_error=self.show_task_error)
 
     def open_notifications(self):
         dialog = NotificationSettingsDialog(self.user_id)
@@ -869,11 +1187,10 @@ class LoginForm(QWidget):
         username = self.username_input.text().strip()
         password = self.password_input.text().strip()
         password_hash = hash_password(password)
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, role FROM users WHERE username=%s AND password_hash=%s", (username, password_hash))
-        user = cursor.fetchone()
-        conn.close()
+        with get_db_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, role FROM users WHERE username=%s AND password_hash=%s", (username, password_hash))
+            user = cursor.fetchone()
         if user:
             self.login_callback(user[0], user[1])
         else:
@@ -946,9 +1263,14 @@ def apply_dark_theme(app):
 
 
 def main():
-    initialize_databases()
+    migrated = initialize_databases()
     app = QApplication(sys.argv)
     apply_dark_theme(app)
+    if not migrated:
+        QMessageBox.critical(None, "Database Needs Migration",
+                             "This database uses an older metrics layout. Start the server once to migrate it, "
+                             "then start the dashboard again.")
+        sys.exit(1)
     window = AppWindow()
     window.show()
     sys.exit(app.exec())
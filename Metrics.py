@@ -1,3 +1,14 @@
+METRIC_FIELDS = (
+    "load_time", "memory_usage", "cpu_time", "dom_nodes",
+    "total_page_size", "fcp", "network_requests", "script_size"
+)
+# Notification rule types. Metric rules compare one of METRIC_FIELDS against a threshold; series rules
+# also look back over the last `window_size` samples.
+SERIES_RULE_TYPES = ("zscore", "ewma", "consecutive")
+METRIC_RULE_TYPES = ("hard_cap", "percent_cap", *SERIES_RULE_TYPES)
+NOTIFICATION_TYPES = (*METRIC_RULE_TYPES, "on_down", "on_broken_link")
+
+
 class Metrics:
     def __init__(self, url, **kwargs):
         self.url = url
@@ -3,8 +3,23 @@ from PySide6.QtWidgets import (
     QDialog, QLabel, QVBoxLayout, QComboBox, QLineEdit, QPushButton, QMessageBox
 )
 from config import get_db_conn
+from Metrics import METRIC_FIELDS, METRIC_RULE_TYPES, SERIES_RULE_TYPES, NOTIFICATION_TYPES
+from anomaly import DEFAULT_WINDOWS, MAX_WINDOW, min_window
 import re
 
+THRESHOLD_LABELS = {
+    "hard_cap": "Threshold (metric value):",
+    "percent_cap": "Threshold (% above baseline):",
+    "zscore": "Threshold (standard deviations above the window mean):",
+    "ewma": "Threshold (standard deviations above the moving average):",
+    "consecutive": "Threshold (metric value):",
+}
+WINDOW_LABELS = {
+    "zscore": "Window (samples compared against):",
+    "ewma": "Window (samples, sets the averaging span):",
+    "consecutive": "Consecutive samples above the threshold:",
+}
+
 class NotificationSettingsDialog(QDialog):
     def __init__(self, user_id):
         super().__init__()
@@ -18,6 +33,9 @@ class NotificationSettingsDialog(QDialog):
         self.metric_dropdown = QComboBox()
         self.type_dropdown = QComboBox()
         self.threshold_input = QLineEdit()
+        self.threshold_label = QLabel("Threshold (for cap types):")
+        self.window_input = QLineEdit()
+        self.window_label = QLabel("Window:")
         self.email_input = QLineEdit()
         self.save_btn = QPushButton("Save Notification")
         self.notification_dropdown = QComboBox()
@@ -34,8 +52,10 @@ class NotificationSettingsDialog(QDialog):
         layout.addWidget(self.type_dropdown)
         layout.addWidget(QLabel("Metric:"))
         layout.addWidget(self.metric_dropdown)
-        layout.addWidget(QLabel("Threshold (for cap types):"))
+        layout.addWidget(self.threshold_label)
         layout.addWidget(self.threshold_input)
+        layout.addWidget(self.window_label)
+        layout.addWidget(self.window_input)
         layout.addWidget(QLabel("Notification Email:"))
         layout.addWidget(self.email_input)
         layout.addWidget(self.save_btn)
@@ -53,13 +73,8 @@ class NotificationSettingsDialog(QDialog):
 
         self.setLayout(layout)
 
-        self.type_dropdown.addItems([
-            "hard_cap", "percent_cap", "on_down", "on_broken_link"
-        ])
-        self.metric_dropdown.addItems([
-            "load_time", "memory_usage", "cpu_time", "dom_nodes",
-            "total_page_size", "fcp", "network_requests", "script_size"
-        ])
+        self.type_dropdown.addItems(list(NOTIFICATION_TYPES))
+        self.metric_dropdown.addItems(list(METRIC_FIELDS))
 
         self.type_dropdown.currentTextChanged.connect(self.update_input_visibility)
         self.update_input_visibility(self.type_dropdown.currentText())
@@ -70,12 +85,22 @@ class NotificationSettingsDialog(QDialog):
         self.save_btn.clicked.connect(self.save_notification)
 
     def update_input_visibility(self, notif_type):
-        if notif_type in ("hard_cap", "percent_cap"):
+        if notif_type in METRIC_RULE_TYPES:
             self.metric_dropdown.setEnabled(True)
             self.threshold_input.setEnabled(True)
+            self.threshold_label.setText(THRESHOLD_LABELS[notif_type])
         else:
             self.metric_dropdown.setEnabled(False)
             self.threshold_input.setEnabled(False)
+            self.threshold_label.setText("Threshold (for cap types):")
+        if notif_type in SERIES_RULE_TYPES:
+            self.window_input.setEnabled(True)
+            self.window_label.setText(WINDOW_LABELS[notif_type])
+            self.window_input.setPlaceholderText(str(DEFAULT_WINDOWS[notif_type]))
+        else:
+            self.window_input.setEnabled(False)
+            self.window_label.setText("Window:")
+            self.window_input.setPlaceholderText("")
 
     def populate_urls(self):
         conn = get_db_conn()
@@ -105,9 +130,10 @@ class NotificationSettingsDialog(QDialog):
         metric = self.metric_dropdown.currentText()
         notif_type = self.type_dropdown.currentText()
         threshold = self.threshold_input.text().strip()
+        window_size = self.window_input.text().strip()
         email = self.email_input.text().strip()
 
-        if notif_type in ("hard_cap", "percent_cap"):
+        if notif_type in METRIC_RULE_TYPES:
             try:
                 threshold = float(threshold)
             except ValueError:
@@ -117,6 +143,16 @@ class NotificationSettingsDialog(QDialog):
             threshold = None
             metric = None
 
+        if notif_type in SERIES_RULE_TYPES and window_size:
+            lowest = min_window(notif_type)
+            if not window_size.isdigit() or not lowest <= int(window_size) <= MAX_WINDOW:
+                QMessageBox.warning(self, "Invalid Input",
+                                    f"Window must be a whole number from {lowest} to {MAX_WINDOW}.")
+                return
+            window_size = int(window_size)
+        else:
+            window_size = None
+
         if not email:
             QMessageBox.warning(self, "Missing Email", "Please enter your email.")
             return
@@ -130,25 +166,9 @@ class NotificationSettingsDialog(QDialog):
         conn = get_db_conn()
         cursor = conn.cursor()
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notifications (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER,
-                url_id INTEGER,
-                metric TEXT,
-                type TEXT CHECK(type IN ('hard_cap', 'percent_cap', 'on_down', 'on_broken_link')),
-                threshold REAL,
-                last_value REAL,
-                email TEXT,
-                last_notified TIMESTAMP,
-                active BOOLEAN DEFAULT TRUE,
-                FOREIGN KEY(user_id) REFERENCES users(id),
-                FOREIGN KEY(url_id) REFERENCES urls(id)
-            )
-        ''')
-        cursor.execute('''
-            INSERT INTO notifications (user_id, url_id, metric, type, threshold, email)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (self.user_id, url_id, metric, notif_type, threshold, email))
+            INSERT INTO notifications (user_id, url_id, metric, type, threshold, window_size, email)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', (self.user_id, url_id, metric, notif_type, threshold, window_size, email))
         cursor.execute("UPDATE users SET email = %s WHERE id = %s", (email, self.user_id))
         conn.commit()
         conn.close()
@@ -160,14 +180,16 @@ class NotificationSettingsDialog(QDialog):
         conn = get_db_conn()
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT n.id, n.type, n.metric, n.threshold, uu.url_nick, n.active
+            SELECT n.id, n.type, n.metric, n.threshold, n.window_size, uu.url_nick, n.active
             FROM notifications n
             JOIN user_urls uu ON n.url_id = uu.url_id AND n.user_id = uu.user_id
             WHERE n.user_id = %s
         """, (self.user_id,))
         self.notifications_map = {}
-        for notif_id, notif_type, metric, threshold, url_nick, active in cursor.fetchall():
+        for notif_id, notif_type, metric, threshold, window_size, url_nick, active in cursor.fetchall():
             label = f"{url_nick}: {notif_type} - {metric or 'N/A'} - {threshold or 'N/A'}"
+            if notif_type in SERIES_RULE_TYPES:
+                label += f" over {window_size or DEFAULT_WINDOWS[notif_type]}"
             if not active:
                 label += " [DISABLED]"
             self.notification_dropdown.addItem(label, notif_id)
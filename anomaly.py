@@ -0,0 +1,102 @@
+import numpy as np
+
+# Statistical rules read the last `window` samples of every (url, browser, group) series of a URL.
+# Each series is one row of a matrix, newest sample in the last column, NaN where nothing was measured,
+# so every watched series is scored by the same few array operations. Metrics are all "higher is worse",
+# so only upward deviations fire.
+DEFAULT_WINDOWS = {"zscore": 20, "ewma": 20, "consecutive": 3}
+MAX_WINDOW = 200
+# zscore and ewma need this many historical samples before they can fire, so their window is at least that
+MIN_HISTORY = 5
+# A history whose spread is below this fraction of its mean counts as flat and is not scored
+FLAT_TOLERANCE = 1e-9
+
+
+def min_window(notif_type):
+    return MIN_HISTORY if notif_type in ("zscore", "ewma") else 1
+
+
+def rule_window(notif_type, window):
+    return min(max(int(window or DEFAULT_WINDOWS[notif_type]), min_window(notif_type)), MAX_WINDOW)
+
+
+def deviations(latest, mean, std):
+    # (latest - mean) / std, NaN where the history has no spread: a flat integer series would
+    # otherwise score inf on any change at all
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(std > FLAT_TOLERANCE * np.abs(mean), (latest - mean) / std, np.nan)
+
+
+def right_align(sequences, width):
+    # Oldest-first sequences -> (len(sequences), width) float matrix, newest in the last column
+    matrix = np.full((len(sequences), width), np.nan)
+    for row, values in enumerate(sequences):
+        values = np.asarray(values[-width:], dtype=float)
+        if len(values):
+            matrix[row, width - len(values):] = values
+    matrix[matrix < 0] = np.nan  # clients send -1 for "not measured"
+    return matrix
+
+
+def zscore(history, latest):
+    count = np.sum(~np.isnan(history), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(history, axis=1) / count
+        std = np.sqrt(np.nansum((history - mean[:, None]) ** 2, axis=1) / count)
+    return count, deviations(latest, mean, std)
+
+
+def ewma(history, latest, alpha):
+    # Exponentially weighted mean and variance, run across the columns for all rows at once
+    mean = np.full(len(history), np.nan)
+    var = np.zeros(len(history))
+    for column in history.T:
+        seen = ~np.isnan(column)
+        first = seen & np.isnan(mean)
+        mean = np.where(first, column, mean)
+        step = seen & ~first
+        delta = np.where(step, column - mean, 0.0)
+        mean = mean + alpha * delta
+        var = np.where(step, (1 - alpha) * (var + alpha * delta * delta), var)
+    count = np.sum(~np.isnan(history), axis=1)
+    return count, deviations(latest, mean, np.sqrt(var))
+
+
+def score_series(notif_types, values, thresholds, windows):
+    # values: (rows, width) matrix from right_align with width > max(windows); one row per (rule, series)
+    # pair, with that rule's type, threshold and window. Returns (fired, score) per row.
+    notif_types = np.asarray(notif_types)
+    thresholds = np.asarray(thresholds, dtype=float)
+    windows = np.asarray(windows)
+    width = values.shape[1]
+    latest = values[:, -1]
+    # History is the `window` samples before the latest one; consecutive also counts the latest
+    columns = np.arange(width - 1)
+    history = np.where(columns >= width - 1 - windows[:, None], values[:, :-1], np.nan)
+
+    fired = np.zeros(len(values), dtype=bool)
+    score = np.full(len(values), np.nan)
+
+    rows = notif_types == "zscore"
+    if rows.any():
+        count, z = zscore(history[rows], latest[rows])
+        score[rows] = z
+        fired[rows] = (count >= MIN_HISTORY) & (z >= thresholds[rows])
+
+    rows = notif_types == "ewma"
+    if rows.any():
+        count, z = ewma(history[rows], latest[rows], 2.0 / (windows[rows] + 1))
+        score[rows] = z
+        fired[rows] = (count >= MIN_HISTORY) & (z >= thresholds[rows])
+
+    rows = notif_types == "consecutive"
+    if rows.any():
+        recent = np.arange(width) >= width - windows[rows][:, None]
+        with np.errstate(invalid="ignore"):
+            breached = values[rows] > thresholds[rows][:, None]
+        run = np.where(recent, breached, True).all(axis=1)
+        score[rows] = latest[rows]
+        fired[rows] = run
+
+    fired &= ~np.isnan(latest) & ~np.isnan(score)
+    return fired, score
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import shutil
+import threading
+import numpy as np
+from datetime import datetime
+from config import get_db_conn, METRICS_ARCHIVE_DIR
+from schema import metrics_partitions
+
+# usage: python archive.py list
+#        python archive.py export TABLE [TABLE ...]
+#        python archive.py export-archived [--drop]
+# Writes metrics partitions (or tables detached by the "archive" retention action) to one .npy file per
+# column, sorted by series, so readers can memory-map them and seek by url_id without the database.
+ARCHIVE_COLUMNS = (
+    ("url_id", "int32"),
+    ("browser_id", "int16"),
+    ("group_id", "int32"),
+    ("timestamp", "datetime64[s]"),
+    ("is_up", "int8"),
+    ("load_time", "float32"),
+    ("memory_usage", "float32"),
+    ("cpu_time", "float32"),
+    ("dom_nodes", "int32"),
+    ("total_page_size", "float32"),
+    ("fcp", "float32"),
+    ("network_requests", "int32"),
+    ("script_size", "float32"),
+    ("broken_link_count", "int32"),
+)
+EXPORT_FETCH_ROWS = 50000
+
+
+def archivable_tables(cursor):
+    # name -> (start, end) for live partitions and detached archived_ partitions
+    tables = {name: (start, end) for name, start, end in metrics_partitions(cursor)}
+    cursor.execute("""
+        SELECT tablename FROM pg_tables
+        WHERE schemaname = current_schema() AND tablename LIKE 'archived\\_metrics\\_p%'
+    """)
+    for (name,) in cursor.fetchall():
+        tables.setdefault(name, (None, None))
+    return tables
+
+
+def column_array(values, dtype):
+    if dtype.startswith("float"):
+        return np.array([np.nan if v is None else v for v in values], dtype=dtype)
+    if dtype.startswith("datetime"):
+        return np.array(values, dtype=dtype)
+    # NULL integers use the same -1 marker clients send for "not measured"
+    return np.array([-1 if v is None else v for v in values], dtype=dtype)
+
+
+def export_table(conn, table, bounds, archive_dir=METRICS_ARCHIVE_DIR):
+    names = [name for name, _ in ARCHIVE_COLUMNS]
+    select = ", ".join("COALESCE(group_id, 0)" if name == "group_id" else name for name in names)
+    target = os.path.join(archive_dir, table.removeprefix("archived_"))
+    staging = target + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    # The count and the rows come from one snapshot, so the preallocated files are exactly filled
+    cursor = conn.cursor()
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute(f"SELECT count(*) FROM {table}")
+    rows = cursor.fetchone()[0]
+    # Every chunk goes straight into memory-mapped .npy files, so memory use stays at one chunk
+    columns = {
+        name: np.lib.format.open_memmap(os.path.join(staging, f"{name}.npy"), mode="w+", dtype=dtype, shape=(rows,))
+        for name, dtype in ARCHIVE_COLUMNS
+    }
+    # Server-side cursor so a large partition streams instead of loading into the client at once
+    cursor = conn.cursor(name=f"export_{table}")
+    cursor.itersize = EXPORT_FETCH_ROWS
+    cursor.execute(f"SELECT {select} FROM {table} ORDER BY url_id, browser_id, group_id, timestamp")
+    offset = 0
+    while True:
+        batch = cursor.fetchmany(EXPORT_FETCH_ROWS)
+        if not batch:
+            break
+        for (name, dtype), values in zip(ARCHIVE_COLUMNS, zip(*batch)):
+            columns[name][offset:offset + len(batch)] = column_array(values, dtype)
+        offset += len(batch)
+    cursor.close()
+    conn.commit()
+
+    start, end = bounds
+    timestamps = columns["timestamp"]
+    meta = {
+        "table": table,
+        "rows": rows,
+        "start": str(start) if start else (str(timestamps.min()) if rows else None),
+        "end": str(end) if end else (str(timestamps.max()) if rows else None),
+        "exported_at": datetime.now().isoformat(timespec="seconds"),
+        "columns": dict(ARCHIVE_COLUMNS),
+    }
+    for column in columns.values():
+        column.flush()
+    del columns, timestamps
+    with open(os.path.join(staging, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    # Swap in whole so readers never see a half-written archive
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+    return rows
+
+
+class ArchiveReader:
+    """Memory-maps every exported partition under `directory`; nothing is read until it is sliced."""
+
+    def __init__(self, directory=METRICS_ARCHIVE_DIR):
+        self.parts = []
+        if not os.path.isdir(directory):
+            return
+        for entry in sorted(os.listdir(directory)):
+            path = os.path.join(directory, entry)
+            meta_path = os.path.join(path, "meta.json")
+            if not os.path.isfile(meta_path):
+                continue
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if not meta["rows"]:
+                continue
+            columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name, _ in ARCHIVE_COLUMNS}
+            start = np.datetime64(meta["start"].replace(" ", "T"), "s")
+            end = np.datetime64(meta["end"].replace(" ", "T"), "s")
+            self.parts.append((start, end, columns))
+        self.parts.sort(key=lambda part: part[0])
+
+    def series(self, url_id, browser_ids=None, group_id=None, start=None, end=None):
+        # Rows for one URL, optionally narrowed by browsers, group and [start, end); oldest first
+        start = np.datetime64(start, "s") if start is not None else None
+        end = np.datetime64(end, "s") if end is not None else None
+        pieces = []
+        for part_start, part_end, columns in self.parts:
+            if (end is not None and part_start >= end) or (start is not None and part_end < start):
+                continue
+            lo, hi = np.searchsorted(columns["url_id"], [url_id, url_id + 1])
+            if lo == hi:
+                continue
+            mask = np.ones(hi - lo, dtype=bool)
+            if browser_ids is not None:
+                mask &= np.isin(columns["browser_id"][lo:hi], browser_ids)
+            if group_id is not None:
+                mask &= columns["group_id"][lo:hi] == group_id
+            timestamps = columns["timestamp"][lo:hi]
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps < end
+            pieces.append({name: np.asarray(columns[name][lo:hi])[mask] for name, _ in ARCHIVE_COLUMNS})
+        if not pieces:
+            return {name: np.array([], dtype=dtype) for name, dtype in ARCHIVE_COLUMNS}
+        merged = {name: np.concatenate([piece[name] for piece in pieces]) for name, _ in ARCHIVE_COLUMNS}
+        # Each partition is sorted by series, so browsers interleave; order by time for plotting
+        order = np.argsort(merged["timestamp"], kind="stable")
+        return {name: values[order] for name, values in merged.items()}
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def get_archive_reader(directory=METRICS_ARCHIVE_DIR):
+    # One shared reader per directory, reopened only when an export has swapped a partition in or out
+    try:
+        version = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        version = None
+    with _readers_lock:
+        cached = _readers.get(directory)
+        if cached is None or cached[0] != version:
+            cached = _readers[directory] = (version, ArchiveReader(directory))
+        return cached[1]
+
+
+def main(args):
+    command = args[0] if args else "list"
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        tables = archivable_tables(cursor)
+        conn.commit()
+        if command == "list":
+            for name, (start, end) in sorted(tables.items()):
+                print(f"{name:<32} {start or '-'} .. {end or '-'}")
+            return
+        if command == "export":
+            names = args[1:]
+        elif command == "export-archived":
+            names = [name for name in tables if name.startswith("archived_")]
+        else:
+            print(f"Unknown command {command!r}")
+            sys.exit(1)
+        for name in names:
+            if name not in tables:
+                print(f"[ARCHIVE] {name} is not a metrics partition; skipped.")
+                continue
+            rows = export_table(conn, name, tables[name])
+            print(f"[ARCHIVE] {name}: {rows} rows -> {METRICS_ARCHIVE_DIR}")
+            if command == "export-archived" and "--drop" in args:
+                cursor.execute(f"DROP TABLE {name}")
+                conn.commit()
+                print(f"[ARCHIVE] Dropped {name}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
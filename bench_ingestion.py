@@ -0,0 +1,63 @@
+import sys
+import time
+import random
+from datetime import datetime
+from Metrics import Metrics, METRIC_FIELDS
+from config import get_db_conn
+from server import initialize_databases, insert_metrics, insert_metrics_batch
+
+BENCH_URL = "bench://ingestion"
+
+
+def make_metrics(count):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    metrics_list = []
+    for i in range(count):
+        values = {name: random.uniform(0, 1000) for name in METRIC_FIELDS}
+        metrics_list.append(Metrics(
+            BENCH_URL,
+            broken_links=["https://example.com/missing"] if i % 10 == 0 else [],
+            timestamp=now,
+            browser_id=i % 3 + 1,
+            is_up=1,
+            group_id=None,
+            **values
+        ))
+    return metrics_list
+
+
+def cleanup():
+    conn = get_db_conn()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM urls WHERE url = %s", (BENCH_URL,))  # metrics rows cascade
+    conn.commit()
+    conn.close()
+
+
+def run(label, insert, metrics_list, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(metrics_list), batch_size):
+        insert(metrics_list[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {len(metrics_list):>7} rows in {elapsed:8.3f}s  {len(metrics_list) / elapsed:10.1f} rows/sec")
+    cleanup()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    initialize_databases()
+    cleanup()
+    metrics_list = make_metrics(rows)
+
+    def insert_one_by_one(batch):
+        for m in batch:
+            insert_metrics(m)
+
+    run("per-row insert_metrics", insert_one_by_one, metrics_list, batch_size)
+    run(f"insert_metrics_batch ({batch_size})", insert_metrics_batch, metrics_list, batch_size)
+    run("insert_metrics_batch (all)", insert_metrics_batch, metrics_list, len(metrics_list))
+
+
+if __name__ == "__main__":
+    main()
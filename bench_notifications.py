@@ -0,0 +1,151 @@
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+from psycopg2.extras import execute_values
+from Metrics import Metrics, METRIC_FIELDS, NOTIFICATION_TYPES, SERIES_RULE_TYPES
+from config import get_db_conn, db_pool_stats
+from schema import ensure_notifications_table
+from server import initialize_databases, write_metrics
+from notificationCrawler import check_for_notifications, CRAWLER_TIMEOUT_SECONDS
+
+# usage: python bench_notifications.py [urls] [notifications] [metric_rows] [passes]
+# Fills the database with synthetic URLs, rules and measurements, then times dry-run crawler passes
+# (nothing is mailed) and reports pass duration, statements issued and alerts/sec.
+# Needs the users table the GUI creates on first start.
+BENCH_PREFIX = "bench://notify/"
+BENCH_EMAIL = "bench@example.invalid"
+BROWSERS = (1, 2, 3)
+SAMPLE_SPACING = timedelta(minutes=5)
+WRITE_CHUNK = 5000
+THRESHOLDS = {"hard_cap": 900, "percent_cap": 50, "zscore": 2.5, "ewma": 2.5, "consecutive": 800}
+
+
+def seed_urls(cursor, count):
+    rows = execute_values(cursor, """
+        INSERT INTO urls (url, referenced, forceInactive) VALUES %s
+        ON CONFLICT (url) DO UPDATE SET referenced = 1
+        RETURNING id
+    """, [(f"{BENCH_PREFIX}{i}", 1, 0) for i in range(count)], fetch=True)
+    return [row[0] for row in rows]
+
+
+def seed_metrics(conn, url_ids, count):
+    # Written without the ingestion event, or a running notificationCrawler would mail the bench alerts
+    # Spread evenly over every (url, browser) series, oldest first, with the newest sample at "now"
+    series = [(url_id, browser_id) for url_id in url_ids for browser_id in BROWSERS]
+    per_series = max(count // len(series), 1)
+    now = datetime.now()
+    items = []
+    written = 0
+    for step in range(per_series, 0, -1):
+        timestamp = (now - SAMPLE_SPACING * (step - 1)).strftime("%Y-%m-%d %H:%M:%S")
+        for url_id, browser_id in series:
+            values = {name: random.uniform(0, 1000) for name in METRIC_FIELDS}
+            items.append((url_id, Metrics(
+                f"{BENCH_PREFIX}{url_id}",
+                broken_links=["https://example.com/missing"] if random.random() < 0.02 else [],
+                timestamp=timestamp,
+                browser_id=browser_id,
+                is_up=0 if random.random() < 0.05 else 1,
+                group_id=None,
+                **values
+            )))
+            if len(items) >= WRITE_CHUNK:
+                written += write_metrics(conn.cursor(), items, notify=False)
+                conn.commit()
+                items = []
+    if items:
+        written += write_metrics(conn.cursor(), items, notify=False)
+        conn.commit()
+    return written
+
+
+def seed_notifications(cursor, url_ids, count):
+    rows = []
+    for i in range(count):
+        notif_type = NOTIFICATION_TYPES[i % len(NOTIFICATION_TYPES)]
+        metric = random.choice(METRIC_FIELDS) if notif_type in THRESHOLDS else None
+        window_size = 3 if notif_type == "consecutive" else (20 if notif_type in SERIES_RULE_TYPES else None)
+        rows.append((random.choice(url_ids), metric, notif_type, THRESHOLDS.get(notif_type), window_size, BENCH_EMAIL))
+    execute_values(cursor, """
+        INSERT INTO notifications (url_id, metric, type, threshold, window_size, email) VALUES %s
+    """, rows)
+
+
+def cleanup():
+    conn = get_db_conn()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM notifications WHERE url_id IN (SELECT id FROM urls WHERE url LIKE %s)", (BENCH_PREFIX + "%",))
+    cursor.execute("DELETE FROM urls WHERE url LIKE %s", (BENCH_PREFIX + "%",))  # metrics and derived rows cascade
+    conn.commit()
+    conn.close()
+
+
+def timed_pass(url_ids=None):
+    statements = db_pool_stats()["statements"]
+    start = time.perf_counter()
+    alerts = check_for_notifications(url_ids, dry_run=True)
+    return time.perf_counter() - start, db_pool_stats()["statements"] - statements, len(alerts)
+
+
+def report(label, results, rules):
+    elapsed = sum(result[0] for result in results) / len(results)
+    statements = sum(result[1] for result in results) / len(results)
+    alerts = sum(result[2] for result in results) / len(results)
+    print(f"{label:<24} {elapsed * 1000:9.1f} ms/pass  {statements:6.1f} statements  {alerts:8.1f} alerts"
+          f"  {alerts / elapsed:10.1f} alerts/sec  {rules / elapsed:10.1f} rules/sec")
+
+
+def main():
+    urls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    notifications = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    metric_rows = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    passes = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+    initialize_databases()
+    conn = get_db_conn()
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('users') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        print("The users table is missing; start the GUI once to create the schema.")
+        conn.close()
+        sys.exit(1)
+    # Sweeps of a running crawler would still pick up the bench rules and mail them
+    crawlers = 0
+    cursor.execute("SELECT to_regclass('notification_crawlers') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        cursor.execute("""
+            SELECT count(*) FROM notification_crawlers
+            WHERE heartbeat_at >= CURRENT_TIMESTAMP - make_interval(secs => %s)
+        """, (CRAWLER_TIMEOUT_SECONDS,))
+        crawlers = cursor.fetchone()[0]
+    if crawlers:
+        print(f"{crawlers} notificationCrawler(s) are running; stop them first or they will mail the bench alerts.")
+        conn.close()
+        sys.exit(1)
+    ensure_notifications_table(cursor)
+    conn.commit()
+    conn.close()
+    cleanup()
+
+    try:
+        start = time.perf_counter()
+        with get_db_conn() as conn:
+            url_ids = seed_urls(conn.cursor(), urls)
+            conn.commit()
+            rows = seed_metrics(conn, url_ids, metric_rows)
+            seed_notifications(conn.cursor(), url_ids, notifications)
+            conn.commit()
+        print(f"Seeded {urls} URLs, {notifications} rules and {rows} metric rows in {time.perf_counter() - start:.1f}s")
+
+        report("full sweep", [timed_pass() for _ in range(passes)], notifications)
+        # A LISTEN event names the URLs of one ingestion flush; about 1% of them here
+        event_size = max(urls // 100, 1)
+        report(f"event ({event_size} urls)", [timed_pass(random.sample(url_ids, event_size)) for _ in range(passes)],
+               notifications * event_size / urls)
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+from Metrics import METRIC_FIELDS
+from config import get_db_conn, HANDSHAKE_PORT
+
+# usage: python bench_server_load.py [clients] [seconds] [urls]
+# Starts fake clients against a running server.py and reports peak sessions and assignments/sec.
+SERVER_HOST = os.getenv("SERVER_IP", "127.0.0.1")
+BENCH_PREFIX = "bench://load/"
+# The server's SCHEDULER_REFRESH_INTERVAL; cleanup waits this long between deactivating and deleting
+SCHEDULER_REFRESH_SECONDS = int(os.getenv("SCHEDULER_REFRESH_INTERVAL", "5"))
+
+stats = {"connected": 0, "peak_connected": 0, "assignments": 0, "acks": 0, "errors": 0,
+         "turned_away": 0, "deferred": 0}
+
+
+def setup_urls(count):
+    conn = get_db_conn()
+    cursor = conn.cursor()
+    for i in range(count):
+        cursor.execute("""
+            INSERT INTO urls (url, referenced, forceInactive, check_interval) VALUES (%s, 1, 0, 1)
+            ON CONFLICT (url) DO UPDATE SET referenced = 1, forceInactive = 0, check_interval = 1
+        """, (f"{BENCH_PREFIX}{i}",))
+    conn.commit()
+    conn.close()
+
+
+def cleanup():
+    conn = get_db_conn()
+    cursor = conn.cursor()
+    # Deactivate first and give the running server a scheduler refresh to notice, so it stops offering
+    # the URLs before their rows disappear
+    cursor.execute("UPDATE urls SET referenced = 0 WHERE url LIKE %s AND referenced > 0", (BENCH_PREFIX + "%",))
+    deactivated = cursor.rowcount
+    conn.commit()
+    if deactivated:
+        time.sleep(SCHEDULER_REFRESH_SECONDS + 1)
+    cursor.execute("DELETE FROM metrics WHERE url_id IN (SELECT id FROM urls WHERE url LIKE %s)", (BENCH_PREFIX + "%",))
+    cursor.execute("DELETE FROM urls WHERE url LIKE %s", (BENCH_PREFIX + "%",))
+    conn.commit()
+    conn.close()
+
+
+def fake_metrics(url):
+    return [
+        dict({name: 1.0 for name in METRIC_FIELDS}, url=url, browser_id=browser_id, is_up=1,
+             group_id=None, broken_links=[])
+        for browser_id in (1, 2, 3)
+    ]
+
+
+async def send(writer, obj):
+    writer.write((json.dumps(obj) + "\n").encode("utf-8"))
+    await writer.drain()
+
+
+async def fake_client(deadline):
+    writer = None
+    try:
+        while True:
+            reader, handshake_writer = await asyncio.wait_for(
+                asyncio.open_connection(SERVER_HOST, HANDSHAKE_PORT), deadline - time.monotonic())
+            port = json.loads(await asyncio.wait_for(reader.readline(), deadline - time.monotonic()))
+            handshake_writer.close()
+            if not (isinstance(port, dict) and "retry_after" in port):
+                break
+            stats["turned_away"] += 1
+            await asyncio.sleep(min(port["retry_after"] * random.uniform(1.0, 1.5), max(0, deadline - time.monotonic())))
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(SERVER_HOST, int(port), limit=16 * 1024 * 1024), deadline - time.monotonic())
+        stats["connected"] += 1
+        stats["peak_connected"] = max(stats["peak_connected"], stats["connected"])
+        await send(writer, {"group_id": None})
+        while time.monotonic() < deadline:
+            line = await asyncio.wait_for(reader.readline(), deadline - time.monotonic())
+            if not line:
+                break
+            url = json.loads(line)
+            if isinstance(url, dict) and "ack" in url:
+                stats["acks"] += 1
+                continue
+            if isinstance(url, dict) and "retry_after" in url:
+                stats["deferred"] += 1
+                continue
+            if url == "exit" or not isinstance(url, str):
+                break
+            stats["assignments"] += 1
+            await send(writer, fake_metrics(url))
+            await send(writer, "DONE")
+    except asyncio.TimeoutError:
+        pass
+    except (OSError, ValueError) as e:
+        stats["errors"] += 1
+        print(f"[bench] client error: {e}")
+    finally:
+        if writer is not None:
+            stats["connected"] -= 1
+            writer.close()
+
+
+async def run(clients, seconds):
+    start = time.monotonic()
+    deadline = start + seconds
+    await asyncio.gather(*(fake_client(deadline) for _ in range(clients)))
+    return time.monotonic() - start
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    urls = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+    setup_urls(urls)
+    print(f"Seeded {urls} bench URLs; waiting for the server scheduler to pick them up...")
+    time.sleep(6)
+    try:
+        elapsed = asyncio.run(run(clients, seconds))
+    finally:
+        cleanup()
+    print(f"clients requested:    {clients}")
+    print(f"peak connected:       {stats['peak_connected']}")
+    print(f"assignments:          {stats['assignments']}")
+    print(f"assignments/sec:      {stats['assignments'] / elapsed:.1f}")
+    print(f"durability acks:      {stats['acks']}")
+    print(f"turned away (retry):  {stats['turned_away']}")
+    print(f"deferred assignments: {stats['deferred']}")
+    print(f"client errors:        {stats['errors']}")
+
+
+if __name__ == "__main__":
+    main()
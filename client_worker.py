@@ -5,6 +5,8 @@ from client_browsers import browser_loop
 import psutil
 import os
 import sys
+import time
+import random
 import psycopg2
 from config import get_db_conn, HANDSHAKE_PORT
 
@@ -38,10 +40,17 @@ def remove_lock_file():
         print(f"[WARN] Could not delete lock file: {e}")
 
 def connect_to_server():
-    handshake = HandshakeSocket.create(SERVER_HOST, PERMANENT_PORT)
-    dynamic_port = handshake.receive()
-    handshake.close()
-    return DynamicClientSocket.connect_to_dynamic(SERVER_HOST, dynamic_port)
+    while True:
+        handshake = HandshakeSocket.create(SERVER_HOST, PERMANENT_PORT)
+        dynamic_port = handshake.receive()
+        handshake.close()
+        if isinstance(dynamic_port, dict) and "retry_after" in dynamic_port:
+            # Jitter spreads out clients that were turned away together
+            delay = dynamic_port["retry_after"] * random.uniform(1.0, 1.5)
+            print(f"Server at capacity, retrying in {delay:.0f}s.")
+            time.sleep(delay)
+            continue
+        return DynamicClientSocket.connect_to_dynamic(SERVER_HOST, dynamic_port)
 
 def main():
     if is_another_client_running():
@@ -57,6 +66,7 @@ def main():
     conn.close()
 
     client_socket = connect_to_server()
+    client_socket.send({"group_id": group_id})
     session = requests.Session()
 
     url_queue = Queue()
@@ -1,6 +1,7 @@
-import psycopg2
 import os
+import threading
 from dotenv import load_dotenv
+from dbpool import ConnectionPool
 load_dotenv()
 
 
@@ -12,7 +13,49 @@ DB_PARAMS = {
     'port': os.getenv('DB_PORT', '5432')
 }
 HANDSHAKE_PORT = int(os.getenv("HANDSHAKE_PORT", "65431"))
+# pg_notify channel the server publishes written url_ids on; notification crawlers LISTEN to it
+METRICS_CHANNEL = "metrics_ingested"
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_HEALTH_CHECK = float(os.getenv("DB_POOL_HEALTH_CHECK", "30"))
+
+# metrics is range-partitioned by timestamp: one partition per unit, created ahead of time.
+# Partitions that ended more than METRICS_RETENTION_DAYS ago are dropped or, with "archive",
+# detached and kept as archived_<name> tables. 0 keeps everything.
+METRICS_PARTITION_UNIT = os.getenv("METRICS_PARTITION_UNIT", "week")
+METRICS_PARTITIONS_AHEAD = int(os.getenv("METRICS_PARTITIONS_AHEAD", "2"))
+METRICS_RETENTION_DAYS = int(os.getenv("METRICS_RETENTION_DAYS", "0"))
+METRICS_RETENTION_ACTION = os.getenv("METRICS_RETENTION_ACTION", "drop")
+# Column files written by `python archive.py`, readable without the database
+METRICS_ARCHIVE_DIR = os.getenv("METRICS_ARCHIVE_DIR", "metrics_archive")
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # A forked child must not share the parent's sockets
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                DB_PARAMS,
+                minconn=DB_POOL_MIN,
+                maxconn=DB_POOL_MAX,
+                timeout=DB_POOL_TIMEOUT,
+                health_check_after=DB_POOL_HEALTH_CHECK
+            )
+            _pool_pid = os.getpid()
+        return _pool
 
 
 def get_db_conn():
-    return psycopg2.connect(**DB_PARAMS)
+    # Pooled connection: close() returns it to the pool, and it can be used as a context manager
+    return get_db_pool().connection()
+
+
+def db_pool_stats():
+    return get_db_pool().snapshot()
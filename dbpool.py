@@ -0,0 +1,199 @@
+import time
+import itertools
+import threading
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class PooledConnection:
+    # Behaves like a psycopg2 connection, but close() hands it back to the pool. As a context manager it
+    # commits on success and rolls back on an exception like psycopg2's, then also returns the connection.
+    def __init__(self, pool, conn):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # conn.autocommit = True and friends must reach the real connection
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._conn is not None and not self._conn.closed:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    try:
+                        self._conn.rollback()
+                    except psycopg2.Error:
+                        pass
+        finally:
+            self.close()
+
+    def __del__(self):
+        # Safety net for callers that lose the wrapper without close(), e.g. on an exception
+        self.close()
+
+    def close(self):
+        conn = self.__dict__.get("_conn")
+        if conn is not None:
+            object.__setattr__(self, "_conn", None)
+            self._pool.release(conn)
+
+
+class CountingCursor(extensions.cursor):
+    # Tallies every statement for the owning pool's stats; execute_values counts once per page.
+    # next() on an itertools.count is atomic under the GIL, so no lock is taken per statement.
+    pool = None
+
+    def execute(self, query, vars=None):
+        next(self.pool._statements)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        next(self.pool._statements)
+        return super().executemany(query, vars_list)
+
+
+class ConnectionPool:
+    def __init__(self, db_params, minconn=1, maxconn=10, timeout=30.0, health_check_after=30.0):
+        self.db_params = db_params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self._idle = []  # (conn, returned_at)
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "opened": 0,
+            "closed": 0,
+            "health_check_failures": 0,
+        }
+        self._statements = itertools.count()
+        self._statement_reads = 0
+        self._cursor_factory = type("PoolCursor", (CountingCursor,), {"pool": self})
+        for _ in range(minconn):
+            self._idle.append((self._open(), time.monotonic()))
+            self._size += 1
+
+    def _count(self, name, amount=1):
+        with self._cond:
+            self.stats[name] += amount
+
+    def _open(self):
+        conn = psycopg2.connect(**self.db_params, cursor_factory=self._cursor_factory)
+        self._count("opened")
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._count("closed")
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def connection(self):
+        deadline = time.monotonic() + self.timeout
+        waited_from = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, idle_since = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise PoolError(f"no database connection available within {self.timeout}s")
+                if waited_from is None:
+                    waited_from = time.monotonic()
+                    self.stats["waits"] += 1
+                self._cond.wait(remaining)
+            if waited_from is not None:
+                self.stats["wait_seconds"] += time.monotonic() - waited_from
+            self.stats["checkouts"] += 1
+
+        try:
+            if conn is not None and not self._healthy(conn, idle_since):
+                self._count("health_check_failures")
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        if not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                self._discard(conn)
+        else:
+            self._count("closed")
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            snapshot = dict(self.stats)
+            # Reading the counter advances it too, so earlier reads are subtracted
+            snapshot["statements"] = next(self._statements) - self._statement_reads
+            self._statement_reads += 1
+            snapshot.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max": self.maxconn,
+            })
+        return snapshot
+
+    def close_all(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._size -= len(self._idle)
+            self._idle = []
@@ -1,67 +1,263 @@
 import smtplib
+import queue
+import atexit
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
 from dotenv import load_dotenv
+from Metrics import METRIC_RULE_TYPES
 load_dotenv()
 
 
-# Gmail-specific configuration
+# Defaults are Gmail's; point SMTP_SERVER/SMTP_PORT at a local stand-in with SMTP_STARTTLS=0 for testing
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 SENDER_PASSWORD = os.getenv("SENDER_PASSWORD")
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+# The connection is kept between mails and dropped after this long unused
+SMTP_IDLE_SECONDS = float(os.getenv("SMTP_IDLE_SECONDS", "60"))
+EMAIL_RATE_PER_MINUTE = float(os.getenv("EMAIL_RATE_PER_MINUTE", "20"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "4"))
+EMAIL_RETRY_SECONDS = float(os.getenv("EMAIL_RETRY_SECONDS", "5"))
+# Alerts for the same recipient that arrive within this many seconds go out as one digest; 0 sends each alone
+EMAIL_DIGEST_SECONDS = float(os.getenv("EMAIL_DIGEST_SECONDS", "0"))
 
-def send_notification_email(to_email, url, notif_type, metric=None, value=None, threshold=None):
-    if not SENDER_EMAIL or not SENDER_PASSWORD:
-        print("ERROR: Missing SENDER_EMAIL or SENDER_PASSWORD environment variables.")
-        return False
-
-    if not to_email:
-        print("ERROR: No recipient email specified.")
-        return False
-
-    msg = MIMEMultipart()
-    msg['From'] = SENDER_EMAIL
-    msg['To'] = to_email
-    msg['Subject'] = f"[ALERT] {notif_type.upper()} triggered for {url}"
-
-    body = f"""
-Hello,
-
-This is an automated notification from the URL Monitoring System.
 
+def alert_details(url, notif_type, metric=None, value=None, threshold=None):
+    text = f"""
 Alert Type: {notif_type}
 URL: {url}
 """
 
-    if notif_type in ("hard_cap", "percent_cap") and metric is not None:
-        body += f"""
+    if notif_type in METRIC_RULE_TYPES and metric is not None:
+        text += f"""
 Metric: {metric}
 Value: {value}
 Threshold: {threshold}
 """
 
     if notif_type == "on_down":
-        body += "\nThe site appears to be DOWN.\n"
+        text += "\nThe site appears to be DOWN.\n"
     elif notif_type == "on_broken_link":
-        body += "\nThe page contains broken link(s).\n"
+        text += "\nThe page contains broken link(s).\n"
+    return text
 
+
+def build_message(to_email, alerts):
+    # alerts: dicts of alert_details() arguments; more than one makes a digest
+    msg = MIMEMultipart()
+    msg['From'] = SENDER_EMAIL
+    msg['To'] = to_email
+    if len(alerts) == 1:
+        msg['Subject'] = f"[ALERT] {alerts[0]['notif_type'].upper()} triggered for {alerts[0]['url']}"
+    else:
+        urls = sorted({alert['url'] for alert in alerts})
+        msg['Subject'] = f"[ALERT] {len(alerts)} alerts triggered for {', '.join(urls[:3])}" + \
+                         (f" and {len(urls) - 3} more" if len(urls) > 3 else "")
+
+    body = """
+Hello,
+
+This is an automated notification from the URL Monitoring System.
+"""
+    body += "\n----------------------------------------\n".join(alert_details(**alert) for alert in alerts)
     body += "\nThis message was generated automatically by the system."
 
     msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+
+def is_permanent(error):
+    # 5xx replies and bad credentials won't succeed on retry; dropped connections and 4xx replies may
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return False
+    return isinstance(error, smtplib.SMTPException) or not isinstance(error, OSError)
+
+
+class SmtpConnection:
+    """One authenticated SMTP session, opened on first use and reused until idle or broken."""
+
+    def __init__(self, host=SMTP_SERVER, port=SMTP_PORT, starttls=SMTP_STARTTLS,
+                 username=SENDER_EMAIL, password=SENDER_PASSWORD, idle_seconds=SMTP_IDLE_SECONDS):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.idle_seconds = idle_seconds
+        self.server = None
+        self.last_used = 0.0
+
+    def _open(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.password:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def send(self, msg):
+        if self.server is not None and time.monotonic() - self.last_used > self.idle_seconds:
+            self.close()
+        if self.server is None:
+            self.server = self._open()
+            self.last_used = time.monotonic()
+        try:
+            self.server.sendmail(self.username, msg['To'], msg.as_string())
+        except OSError as e:
+            # A refused message leaves the session usable; anything else (SMTPException is an OSError too)
+            # means it is dead, so drop it and let the next attempt reconnect
+            if isinstance(e, smtplib.SMTPException) and not isinstance(e, smtplib.SMTPServerDisconnected):
+                raise
+            self.server.close()
+            self.server = None
+            raise
+        self.last_used = time.monotonic()
 
-    try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.sendmail(SENDER_EMAIL, to_email, msg.as_string())
-        server.quit()
-        print(f"[EMAIL SENT] to {to_email} for {notif_type} alert on {url}")
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+
+class EmailQueue:
+    """Background delivery: enqueue() returns at once, a worker thread sends over one SMTP connection,
+    paced to `rate_per_minute` mails, with retries and optional per-recipient digests."""
+
+    def __init__(self, connection=None, rate_per_minute=EMAIL_RATE_PER_MINUTE, digest_seconds=EMAIL_DIGEST_SECONDS,
+                 max_attempts=EMAIL_MAX_ATTEMPTS, retry_seconds=EMAIL_RETRY_SECONDS):
+        self.connection = connection or SmtpConnection()
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.digest_seconds = digest_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.queue = queue.Queue()
+        self.next_send = 0.0
+        self.stats = {"sent": 0, "alerts": 0, "failed": 0, "retries": 0}
+        self.worker = threading.Thread(target=self._run, name="email-queue", daemon=True)
+        self.worker.start()
+
+    def enqueue(self, to_email, url, notif_type, metric=None, value=None, threshold=None):
+        if not SENDER_EMAIL:
+            print("ERROR: Missing SENDER_EMAIL environment variable.")
+            return False
+        if not to_email:
+            print("ERROR: No recipient email specified.")
+            return False
+        self.queue.put((to_email, {"url": url, "notif_type": notif_type, "metric": metric,
+                                   "value": value, "threshold": threshold}))
         return True
-    except smtplib.SMTPAuthenticationError:
-        print("[SMTP ERROR] Authentication failed. Use an App Password if using Gmail with 2FA.")
-    except Exception as e:
-        print(f"[SMTP ERROR] {e}")
 
-    return False
+    def flush(self):
+        # Blocks until everything enqueued so far has been sent or given up on
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.digest_seconds
+        while True:
+            try:
+                timeout = deadline - time.monotonic()
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            batch, stopping = self._collect(item)
+            if self.digest_seconds > 0:
+                mails = {}
+                for to_email, alert in batch:
+                    mails.setdefault(to_email, []).append(alert)
+                mails = list(mails.items())
+            else:
+                mails = [(to_email, [alert]) for to_email, alert in batch]
+            for to_email, alerts in mails:
+                self._deliver(to_email, alerts)
+            for _ in range(len(batch) + stopping):
+                self.queue.task_done()
+        self.connection.close()
+
+    def _deliver(self, to_email, alerts):
+        msg = build_message(to_email, alerts)
+        for attempt in range(1, self.max_attempts + 1):
+            delay = self.next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_send = time.monotonic() + self.interval
+            try:
+                self.connection.send(msg)
+                self.stats["sent"] += 1
+                self.stats["alerts"] += len(alerts)
+                print(f"[EMAIL SENT] to {to_email}: {len(alerts)} alert(s)")
+                return True
+            except Exception as e:
+                if isinstance(e, smtplib.SMTPAuthenticationError):
+                    print("[SMTP ERROR] Authentication failed. Use an App Password if using Gmail with 2FA.")
+                else:
+                    print(f"[SMTP ERROR] {e}")
+                if is_permanent(e) or attempt == self.max_attempts:
+                    break
+                self.stats["retries"] += 1
+                time.sleep(self.retry_seconds * 2 ** (attempt - 1))
+        self.stats["failed"] += 1
+        print(f"[EMAIL FAILED] to {to_email}: {len(alerts)} alert(s) dropped")
+        return False
+
+
+_email_queue = None
+_email_queue_lock = threading.Lock()
+
+
+def get_email_queue():
+    global _email_queue
+    with _email_queue_lock:
+        if _email_queue is None:
+            _email_queue = EmailQueue()
+        return _email_queue
+
+
+@atexit.register
+def close_email_queue():
+    # Sends whatever is still queued, then stops the worker. Alerts are claimed in the database before
+    # they are queued, so exiting without this would lose them; it also runs at interpreter exit.
+    global _email_queue
+    with _email_queue_lock:
+        email_queue, _email_queue = _email_queue, None
+    if email_queue is not None:
+        email_queue.close()
+
+
+def send_notification_email(to_email, url, notif_type, metric=None, value=None, threshold=None):
+    # Queued for the shared delivery worker; True means accepted, not yet delivered
+    return get_email_queue().enqueue(to_email, url, notif_type, metric, value, threshold)
@@ -0,0 +1,79 @@
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+
+class TaskSignals(QObject):
+    finished = Signal(object, object)
+    failed = Signal(object, str)
+
+
+class Task(QRunnable):
+    # Runs fn(*args) on a pool thread; results come back through signals, delivered on the GUI thread
+    def __init__(self, key, fn, *args, on_done=None, on_error=None):
+        super().__init__()
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.signals = TaskSignals()
+        self.cancelled = False
+        # Owned from Python: the runner still reads it after run() returns, when its signals arrive
+        self.setAutoDelete(False)
+
+    def run(self):
+        try:
+            result = self.fn(*self.args)
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.failed.emit(self, str(e))
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(self, result)
+
+
+class TaskRunner(QObject):
+    """Keeps blocking database and HTTP calls off the GUI thread. Tasks are keyed by what they load:
+    submitting again under a key cancels the previous task, dropping it if it hasn't started and
+    discarding its result if it has, so only the latest selection ever reaches the widgets."""
+
+    pending_changed = Signal(int)
+
+    def __init__(self, pool=None, parent=None):
+        super().__init__(parent)
+        self.pool = pool or QThreadPool.globalInstance()
+        self.current = {}
+
+    def submit(self, key, fn, *args, on_done=None, on_error=None):
+        self.cancel(key)
+        task = Task(key, fn, *args, on_done=on_done, on_error=on_error)
+        self.current[key] = task
+        # Bound to this GUI-thread object, so the emits from the pool thread arrive queued on the GUI thread
+        task.signals.finished.connect(self._finished)
+        task.signals.failed.connect(self._failed)
+        self.pool.start(task)
+        self.pending_changed.emit(len(self.current))
+        return task
+
+    def cancel(self, key):
+        task = self.current.pop(key, None)
+        if task is None:
+            return
+        task.cancelled = True
+        self.pool.tryTake(task)
+        self.pending_changed.emit(len(self.current))
+
+    def is_pending(self, key):
+        return key in self.current
+
+    def _settle(self, task, callback, value):
+        if self.current.get(task.key) is task:
+            del self.current[task.key]
+            self.pending_changed.emit(len(self.current))
+        if callback is not None and not task.cancelled:
+            callback(value)
+
+    def _finished(self, task, result):
+        self._settle(task, task.on_done, result)
+
+    def _failed(self, task, message):
+        self._settle(task, task.on_error, message)
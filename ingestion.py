@@ -0,0 +1,115 @@
+import time
+import asyncio
+import psycopg2
+from psycopg2.pool import PoolError
+
+
+class IngestionQueue:
+    """Write-behind buffer between client sessions and the database.
+
+    Sessions hand over finished batches with put() and carry on dispatching.
+    A single flusher writes everything pending in one transaction once
+    flush_rows are buffered or flush_seconds have passed. put() blocks while
+    max_rows (or max_bytes of client payload) are pending, which pushes back
+    on the sessions and their sockets.
+    """
+
+    def __init__(self, write_batch, executor, max_rows=10000, flush_rows=500, flush_seconds=1.0, latency=None,
+                 max_bytes=None):
+        self.write_batch = write_batch
+        self.max_bytes = max_bytes
+        self.latency = latency  # optional histogram of per-transaction write times
+        self.executor = executor
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.pending = []  # (lease, metrics_list, future, size)
+        self.pending_rows = 0  # queued plus being flushed, for backpressure
+        self.pending_bytes = 0
+        self.queued_rows = 0
+        self.space = asyncio.Condition()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.stats = {
+            "batches": 0, "flushes": 0, "rows": 0, "failed_batches": 0,
+            "backpressure_waits": 0, "last_flush_seconds": 0.0,
+        }
+
+    def depth(self):
+        return self.pending_rows
+
+    def _fits(self, rows, size):
+        if not self.pending_rows:
+            return True
+        if self.pending_rows + rows > self.max_rows:
+            return False
+        return self.max_bytes is None or self.pending_bytes + size <= self.max_bytes
+
+    async def put(self, lease, metrics_list, size=0):
+        rows = len(metrics_list)
+        async with self.space:
+            if not self._fits(rows, size):
+                self.stats["backpressure_waits"] += 1
+                await self.space.wait_for(lambda: self._fits(rows, size))
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append((lease, metrics_list, future, size))
+            self.pending_rows += rows
+            self.pending_bytes += size
+            self.queued_rows += rows
+        if self.queued_rows >= self.flush_rows:
+            self.wakeup.set()
+        return future
+
+    async def run(self):
+        while not (self.closed and not self.pending):
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.pending:
+                await self.flush()
+
+    async def _write(self, batch):
+        # Connection-level failures fail the whole batch; data errors are bisected so one bad
+        # client batch cannot sink everyone else's
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(self.executor, self.write_batch, [(lease, ms) for lease, ms, _, _ in batch])
+            if self.latency is not None:
+                self.latency.observe(time.perf_counter() - started)
+            return [(future, results.get(lease[0]), None) for lease, _, future, _ in batch]
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError) as e:
+            return [(future, None, e) for _, _, future, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                return [(batch[0][2], None, e)]
+            middle = len(batch) // 2
+            return await self._write(batch[:middle]) + await self._write(batch[middle:])
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        self.queued_rows = 0
+        started = time.perf_counter()
+        outcomes = await self._write(batch)
+        self.stats["last_flush_seconds"] = time.perf_counter() - started
+        self.stats["flushes"] += 1
+        self.stats["batches"] += len(batch)
+        for future, result, error in outcomes:
+            if error is not None:
+                self.stats["failed_batches"] += 1
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                self.stats["rows"] += result[0] if result else 0
+                if not future.done():
+                    future.set_result(result)
+        async with self.space:
+            self.pending_rows -= sum(len(ms) for _, ms, _, _ in batch)
+            self.pending_bytes -= sum(size for _, _, _, size in batch)
+            self.space.notify_all()
+
+    async def close(self):
+        self.closed = True
+        self.wakeup.set()
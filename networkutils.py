@@ -1,5 +1,14 @@
 import json
 import socket
+import asyncio
+
+
+def encode_message(obj):
+    if isinstance(obj, (dict, list, int, float, bool, str, type(None))):
+        json_string = json.dumps(obj)
+        return (json_string + '\n').encode('utf-8')  # Ensure bytes
+    raise TypeError(f"Only JSON-serializable types can be sent. Got: {type(obj)}")
+
 
 class BaseSocket:
     def __init__(self, conn):
@@ -7,11 +16,7 @@ class BaseSocket:
         self.buffer = b""
 
     def send(self, obj):
-        if isinstance(obj, (dict, list, int, float, bool, str, type(None))):
-            json_string = json.dumps(obj)
-            self.conn.sendall((json_string + '\n').encode('utf-8'))  # Ensure bytes
-        else:
-            raise TypeError(f"Only JSON-serializable types can be sent. Got: {type(obj)}")
+        self.conn.sendall(encode_message(obj))
 
     def receive(self):
         while b'\n' not in self.buffer:
@@ -50,4 +55,45 @@ class DynamicClientSocket(BaseSocket):
         self.send("DONE")
 
     def receive_url(self):
-        return self.receive()
+        # Durability acks for earlier results can arrive ahead of the next URL
+        while True:
+            message = self.receive()
+            if isinstance(message, dict) and "ack" in message:
+                state = "stored" if message.get("stored") else "NOT stored, will be re-measured"
+                print(f"Server ack: results for {message.get('url')} {state}.")
+                continue
+            if isinstance(message, dict) and "retry_after" in message:
+                # Server is at capacity; it holds the session and sends the next URL when it can
+                print(f"Server busy, next URL in about {message['retry_after']}s.")
+                continue
+            return message
+
+
+class AsyncJsonSocket:
+    # Same newline-delimited JSON framing as BaseSocket, over asyncio streams
+    def __init__(self, reader, writer, stats=None):
+        self.reader = reader
+        self.writer = writer
+        self.bytes_received = 0
+        self.stats = stats  # optional shared counters, updated as bytes arrive
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, obj):
+        async with self.send_lock:
+            self.writer.write(encode_message(obj))
+            await self.writer.drain()
+
+    async def receive(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\n'):
+            return None
+        self.bytes_received += len(line)
+        if self.stats is not None:
+            self.stats["bytes_received"] += len(line)
+        return json.loads(line.decode('utf-8'))
+
+    def peername(self):
+        return self.writer.get_extra_info("peername")
+
+    def close(self):
+        self.writer.close()
@@ -1,104 +1,358 @@
+import os
+import sys
+import select
+import socket
 import psycopg2
-from config import get_db_conn
+import numpy as np
+from itertools import groupby
+from psycopg2.extras import execute_values
+from config import get_db_conn, DB_PARAMS, METRICS_CHANNEL
 from datetime import datetime, timedelta
-from emailUtils import send_notification_email
+from emailUtils import send_notification_email, close_email_queue
+from Metrics import METRIC_FIELDS, SERIES_RULE_TYPES
+from anomaly import rule_window, right_align, score_series
 import time
 
-def check_for_notifications():
-    conn_metrics = get_db_conn()
-    cursor_metrics = conn_metrics.cursor()
+NOTIFY_COOLDOWN_SECONDS = 900
+RECENT_WINDOW = timedelta(minutes=15)
+# Metric rules may only name these columns; anything else in the table is ignored
+ALLOWED_METRICS = frozenset(METRIC_FIELDS)
+# Series rules read at most this far back, so quiet series don't scan old partitions
+SERIES_LOOKBACK = timedelta(days=float(os.getenv("NOTIFY_SERIES_LOOKBACK_DAYS", "7")))
+# Rules are evaluated as the server announces new metrics; the full sweep only catches missed events
+FULL_SWEEP_SECONDS = int(os.getenv("NOTIFY_FULL_SWEEP_SECONDS", "300"))
+EVENT_BATCH_SECONDS = float(os.getenv("NOTIFY_EVENT_BATCH_SECONDS", "1"))
+# Crawlers split the rules by url_id across the members that heartbeated recently; a crawler that
+# misses CRAWLER_TIMEOUT_SECONDS of heartbeats is dropped and its share moves to the others
+CRAWLER_HEARTBEAT_SECONDS = int(os.getenv("CRAWLER_HEARTBEAT_SECONDS", "10"))
+CRAWLER_TIMEOUT_SECONDS = int(os.getenv("CRAWLER_TIMEOUT_SECONDS", "30"))
 
-    conn_urls = get_db_conn()
-    cursor_urls = conn_urls.cursor()
 
-    now = now = datetime.now()
-    cutoff = now - timedelta(minutes=15)
+def ensure_crawler_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_crawlers (
+            crawler_id TEXT PRIMARY KEY,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            heartbeat_at TIMESTAMP NOT NULL
+        );
+    ''')
 
-    cursor_urls.execute("""
-        SELECT id, user_id, url_id, metric, type, threshold, last_value, email, last_notified 
-        FROM notifications
-        WHERE active = TRUE
-    """)
 
-    notifications = cursor_urls.fetchall()
+def heartbeat(crawler_id):
+    # Returns this crawler's (index, count) among the live crawlers
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO notification_crawlers (crawler_id, heartbeat_at) VALUES (%s, CURRENT_TIMESTAMP)
+            ON CONFLICT (crawler_id) DO UPDATE SET heartbeat_at = EXCLUDED.heartbeat_at
+        """, (crawler_id,))
+        cursor.execute("DELETE FROM notification_crawlers WHERE heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                       (CRAWLER_TIMEOUT_SECONDS,))
+        cursor.execute("SELECT crawler_id FROM notification_crawlers ORDER BY crawler_id")
+        members = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    return members.index(crawler_id), len(members)
 
-    for notif in notifications:
-        notif_id, user_id, url_id, metric, notif_type, threshold, last_value, email, last_notified = notif
 
-        if last_notified and (now - last_notified).total_seconds() < 900:
-            continue  # Skip if notified within the last 15 minutes
+def leave(crawler_id):
+    # Lets the others take over this crawler's share now instead of after the timeout
+    try:
+        with get_db_conn() as conn:
+            conn.cursor().execute("DELETE FROM notification_crawlers WHERE crawler_id = %s", (crawler_id,))
+            conn.commit()
+    except psycopg2.Error as e:
+        print(f"[!] Could not deregister {crawler_id}: {e}")
 
-        cursor_urls.execute("SELECT url FROM urls WHERE id = %s", (url_id,))
-        result = cursor_urls.fetchone()
-        if not result:
-            continue
 
-        url = result[0]
+def load_notifications(cursor, url_ids=None, shard=None):
+    # Active rules with their URL, in one query; only those on url_ids and in shard (index, count) when given
+    query = """
+        SELECT n.id, n.url_id, u.url, n.metric, n.type, n.threshold, n.email, n.last_notified, n.window_size
+        FROM notifications n
+        JOIN urls u ON u.id = n.url_id
+        WHERE n.active = TRUE
+    """
+    params = []
+    if url_ids is not None:
+        query += " AND n.url_id = ANY(%s)"
+        params.append(list(url_ids))
+    if shard is not None:
+        query += " AND mod(n.url_id, %s) = %s"
+        params.extend((shard[1], shard[0]))
+    cursor.execute(query, params)
+    return cursor.fetchall()
 
-        # Recent metrics
-        cursor_metrics.execute("""
-            SELECT * FROM metrics 
-            WHERE url = %s AND timestamp >= %s 
+
+def load_latest(cursor, url_ids, cutoff):
+    # Newest recent measurement per watched URL, across browsers and groups
+    cursor.execute("""
+        SELECT DISTINCT ON (url_id) *
+        FROM latest_metrics
+        WHERE url_id = ANY(%s) AND timestamp >= %s
+        ORDER BY url_id, timestamp DESC
+    """, (list(url_ids), cutoff))
+    column_names = [desc[0] for desc in cursor.description]
+    return {row[0]: dict(zip(column_names, row)) for row in cursor.fetchall()}
+
+
+def load_baselines(cursor, pairs):
+    # Rolling baseline per (url_id, metric) for percent_cap rules: one primary-key row each,
+    # maintained by the server as metrics are ingested
+    if not pairs:
+        return {}
+    url_ids, metrics = zip(*pairs)
+    cursor.execute("""
+        SELECT b.url_id, b.metric, b.weighted_sum / NULLIF(b.weight, 0)
+        FROM metric_baselines b
+        JOIN unnest(%s::int[], %s::text[]) AS p(url_id, metric) ON p.url_id = b.url_id AND p.metric = b.metric
+    """, (list(url_ids), list(metrics)))
+    return {(url_id, metric): avg for url_id, metric, avg in cursor.fetchall() if avg is not None}
+
+
+def load_series(cursor, url_ids, metrics, width, cutoff, since):
+    # The last `width` samples of every recently measured (url, browser, group) series of url_ids, as one
+    # right-aligned matrix per metric; the LATERAL walks idx_metrics_series backwards per series.
+    # latest_metrics stores "no group" as 0 and metrics as NULL; each branch has an indexable group
+    # predicate and only the one matching l.group_id runs.
+    metrics = sorted(metrics)
+    columns = ", ".join(f"m.{name}" for name in metrics)
+    cursor.execute(f"""
+        SELECT l.url_id, l.browser_id, l.group_id, {", ".join(f"s.{name}" for name in metrics)}
+        FROM latest_metrics l
+        CROSS JOIN LATERAL (
+            (SELECT m.timestamp, {columns}
+             FROM metrics m
+             WHERE l.group_id <> 0 AND m.url_id = l.url_id AND m.browser_id = l.browser_id
+               AND m.group_id = l.group_id AND m.timestamp >= %(since)s)
+            UNION ALL
+            (SELECT m.timestamp, {columns}
+             FROM metrics m
+             WHERE l.group_id = 0 AND m.url_id = l.url_id AND m.browser_id = l.browser_id
+               AND m.group_id IS NULL AND m.timestamp >= %(since)s)
             ORDER BY timestamp DESC
-        """, (url, cutoff))
-        recent_rows = cursor_metrics.fetchall()
-        if not recent_rows:
-            continue
-
-        column_names = [desc[0] for desc in cursor_metrics.description]
-        metrics_list = [dict(zip(column_names, row)) for row in recent_rows]
-        latest_metrics = metrics_list[0]
-        triggered = False
-
-        if notif_type == "hard_cap" and metric in latest_metrics and latest_metrics[metric] is not None:
-            if latest_metrics[metric] > threshold:
-                triggered = True
-
-        elif notif_type == "percent_cap" and metric in latest_metrics and latest_metrics[metric] is not None:
-            # Calculate weekly average
-            week_ago = week_ago = datetime.now() - timedelta(days=7)
-            cursor_metrics.execute("""
-                SELECT %s FROM metrics WHERE url = %s AND timestamp >= %s
-            """ % (metric, "%s", "%s"), (url, week_ago))
-            values = [row[0] for row in cursor_metrics.fetchall() if row[0] is not None]
-
-            if values:
-                weekly_avg = sum(values) / len(values)
-                try:
-                    percent_change = ((latest_metrics[metric] - weekly_avg) / weekly_avg) * 100
-                    if percent_change >= threshold:
-                        triggered = True
-                except ZeroDivisionError:
-                    continue
-
-        elif notif_type == "on_down" and latest_metrics.get("is_up") == 0:
-            triggered = True
-
-        elif notif_type == "on_broken_link" and latest_metrics.get("broken_links"):
-            triggered = True
+            LIMIT %(width)s
+        ) AS s
+        WHERE l.url_id = ANY(%(url_ids)s) AND l.timestamp >= %(cutoff)s
+        ORDER BY l.url_id, l.browser_id, l.group_id, s.timestamp
+    """, {"since": since, "width": width, "url_ids": list(url_ids), "cutoff": cutoff})
+    keys, samples = [], []
+    for key, rows in groupby(cursor.fetchall(), key=lambda row: row[:3]):
+        keys.append(key)
+        samples.append([row[3:] for row in rows])
+    return keys, {
+        name: right_align([[sample[index] for sample in series] for series in samples], width)
+        for index, name in enumerate(metrics)
+    }
+
+
+def evaluate_series_rules(cursor, rules, now):
+    # rules: (notif_id, url_id, metric, notif_type, threshold, window_size). Every (rule, series) pair
+    # becomes one matrix row and is scored in a single pass; returns {notif_id: latest value} of rules
+    # that fired on any of their URL's series.
+    rules = [rule for rule in rules if rule[2] in ALLOWED_METRICS and rule[4] is not None]
+    if not rules:
+        return {}
+    windows = [rule_window(notif_type, window_size) for _, _, _, notif_type, _, window_size in rules]
+    width = max(windows) + 1
+    keys, series = load_series(cursor, {rule[1] for rule in rules}, {rule[2] for rule in rules},
+                               width, now - RECENT_WINDOW, now - SERIES_LOOKBACK)
+    series_by_url = {}
+    for index, key in enumerate(keys):
+        series_by_url.setdefault(key[0], []).append(index)
+    pairs = [(rule_index, series_index) for rule_index, rule in enumerate(rules)
+             for series_index in series_by_url.get(rule[1], ())]
+    if not pairs:
+        return {}
+    rule_rows, series_rows = np.array(pairs).T
+    metrics = np.array([rule[2] for rule in rules])[rule_rows]
+    values = np.empty((len(pairs), width))
+    for name, matrix in series.items():
+        rows = metrics == name
+        values[rows] = matrix[series_rows[rows]]
+    fired, score = score_series(
+        np.array([rule[3] for rule in rules])[rule_rows], values,
+        np.array([rule[4] for rule in rules])[rule_rows], np.array(windows)[rule_rows]
+    )
+    strongest = {}
+    for row in np.flatnonzero(fired):
+        notif_id = rules[rule_rows[row]][0]
+        if notif_id not in strongest or score[row] > strongest[notif_id][1]:
+            strongest[notif_id] = (float(values[row, -1]), score[row])
+    return {notif_id: value for notif_id, (value, _) in strongest.items()}
+
+
+def evaluate(notif_type, metric, threshold, latest_metrics, baseline):
+    value = latest_metrics.get(metric) if metric in ALLOWED_METRICS else None
+    if value is not None and value < 0:
+        value = None  # not measured
+    if notif_type == "hard_cap":
+        return value is not None and value > threshold
+    if notif_type == "percent_cap":
+        return value is not None and bool(baseline) and ((value - baseline) / baseline) * 100 >= threshold
+    if notif_type == "on_down":
+        return latest_metrics.get("is_up") == 0
+    if notif_type == "on_broken_link":
+        return (latest_metrics.get("broken_link_count") or 0) > 0
+    return False
+
+
+def check_for_notifications(url_ids=None, shard=None, dry_run=False):
+    # A fixed handful of queries per pass however many rules there are; updates go back in one batch.
+    # Returns {notif_id: alert} of what was sent or, with dry_run, what would have been, writing nothing.
+    conn = get_db_conn()
+    try:
+        cursor = conn.cursor()
+
+        now = datetime.now()
+        notifications = [
+            n for n in load_notifications(cursor, url_ids, shard)
+            if not (n[7] and (now - n[7]).total_seconds() < NOTIFY_COOLDOWN_SECONDS)
+        ]
+        latest = load_latest(cursor, {n[1] for n in notifications}, now - RECENT_WINDOW)
+        baselines = load_baselines(cursor, {
+            (url_id, metric) for _, url_id, _, metric, notif_type, _, _, _, _ in notifications
+            if notif_type == "percent_cap" and metric in ALLOWED_METRICS and latest.get(url_id, {}).get(metric) is not None
+        })
+        series_fired = evaluate_series_rules(cursor, [
+            (notif_id, url_id, metric, notif_type, threshold, window_size)
+            for notif_id, url_id, _, metric, notif_type, threshold, _, _, window_size in notifications
+            if notif_type in SERIES_RULE_TYPES and url_id in latest
+        ], now)
+
+        triggered = {}
+        last_values = []
+        for notif_id, url_id, url, metric, notif_type, threshold, email, _, _ in notifications:
+            if url_id not in latest:
+                continue
+            latest_metrics = latest[url_id]
 
+            if notif_id in series_fired:
+                triggered[notif_id] = dict(
+                    to_email=email,
+                    url=url,
+                    notif_type=notif_type,
+                    metric=metric,
+                    value=series_fired[notif_id],
+                    threshold=threshold
+                )
+            elif evaluate(notif_type, metric, threshold, latest_metrics, baselines.get((url_id, metric))):
+                triggered[notif_id] = dict(
+                    to_email=email,
+                    url=url,
+                    notif_type=notif_type,
+                    metric=metric,
+                    value=latest_metrics.get(metric),
+                    threshold=threshold
+                )
+
+            # Always update last_value for percent notifications
+            if notif_type == "percent_cap" and metric in ALLOWED_METRICS and latest_metrics.get(metric) is not None:
+                last_values.append((notif_id, latest_metrics[metric]))
+
+        if dry_run:
+            conn.rollback()
+            return triggered
+
+        claimed = []
         if triggered:
-            send_notification_email(
-                to_email=email,
-                url=url,
-                notif_type=notif_type,
-                metric=metric,
-                value=latest_metrics.get(metric),
-                threshold=threshold
-            )
-
-            # Update last_notified time
-            cursor_urls.execute ("UPDATE notifications SET last_notified = %s WHERE id = %s", (now, notif_id))
-
-        # Always update last_value for percent notifications
-        if notif_type == "percent_cap" and metric in latest_metrics and latest_metrics[metric] is not None:
-            cursor_urls.execute("UPDATE notifications SET last_value = %s WHERE id = %s", (latest_metrics[metric], notif_id))
-
-    conn_urls.commit()
-    conn_metrics.close()
-    conn_urls.close()
+            # Claimed atomically: while shards rebalance two crawlers can briefly evaluate the same rule,
+            # and only the one whose update still sees the cooldown expired sends the mail. The database clock
+            # stamps and compares, so crawlers on hosts with skewed clocks agree.
+            cursor.execute("""
+                UPDATE notifications SET last_notified = CURRENT_TIMESTAMP
+                WHERE id = ANY(%s)
+                  AND (last_notified IS NULL OR last_notified <= CURRENT_TIMESTAMP - make_interval(secs => %s))
+                RETURNING id
+            """, (list(triggered), NOTIFY_COOLDOWN_SECONDS))
+            claimed = [row[0] for row in cursor.fetchall()]
+        if last_values:
+            execute_values(cursor, """
+                UPDATE notifications SET last_value = v.value FROM (VALUES %s) AS v(id, value)
+                WHERE notifications.id = v.id
+            """, last_values)
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    for notif_id in claimed:
+        send_notification_email(**triggered[notif_id])
+    return {notif_id: triggered[notif_id] for notif_id in claimed}
+
+def listen_connection():
+    # Dedicated session: LISTEN belongs to a connection, so this one never goes back to the pool
+    conn = psycopg2.connect(**DB_PARAMS)
+    conn.autocommit = True
+    conn.cursor().execute(f"LISTEN {METRICS_CHANNEL}")
+    return conn
+
+
+def drain_events(listener, url_ids):
+    listener.poll()
+    while listener.notifies:
+        url_ids.update(int(item) for item in listener.notifies.pop(0).payload.split(",") if item)
+
+
+def run():
+    crawler_id = f"{socket.gethostname()}:{os.getpid()}"
+    with get_db_conn() as conn:
+        ensure_crawler_table(conn.cursor())
+        conn.commit()
+    listener = None
+    shard = None
+    next_sweep = next_heartbeat = 0
+    try:
+        while True:
+            try:
+                if listener is None:
+                    listener = listen_connection()
+                    next_sweep = 0  # events sent while disconnected are gone; sweep everything
+                if time.monotonic() >= next_heartbeat:
+                    current = heartbeat(crawler_id)
+                    if current != shard:
+                        print(f"[NOTIFY] {crawler_id} evaluating shard {current[0] + 1} of {current[1]}")
+                        shard = current
+                        next_sweep = 0  # rules that just moved here may have missed their events
+                    next_heartbeat = time.monotonic() + CRAWLER_HEARTBEAT_SECONDS
+                if time.monotonic() >= next_sweep:
+                    check_for_notifications(shard=shard)
+                    next_sweep = time.monotonic() + FULL_SWEEP_SECONDS
+                timeout = max(0, min(next_sweep, next_heartbeat) - time.monotonic())
+                if select.select([listener], [], [], timeout)[0]:
+                    url_ids = set()
+                    drain_events(listener, url_ids)
+                    # A short pause lets a burst of ingestion flushes be evaluated together
+                    time.sleep(EVENT_BATCH_SECONDS)
+                    drain_events(listener, url_ids)
+                    if url_ids:
+                        check_for_notifications(url_ids, shard)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                print(f"[!] Notification listener lost: {e}. Reconnecting...")
+                if listener is not None:
+                    listener.close()
+                listener = None
+                time.sleep(5)
+    finally:
+        try:
+            leave(crawler_id)
+        finally:
+            close_email_queue()
+
+
+def dry_run():
+    # One full pass over every rule, printing what would fire; no mail, no cooldown or last_value writes
+    start = time.perf_counter()
+    alerts = check_for_notifications(dry_run=True)
+    elapsed = time.perf_counter() - start
+    for notif_id, alert in sorted(alerts.items()):
+        print(f"[DRY RUN] #{notif_id} {alert['notif_type']} on {alert['url']} -> {alert['to_email']}"
+              f" (metric={alert['metric']}, value={alert['value']}, threshold={alert['threshold']})")
+    print(f"[DRY RUN] {len(alerts)} alert(s) would fire; pass took {elapsed:.3f}s")
+
 
+# usage: python notificationCrawler.py [--dry-run]
 if __name__ == "__main__":
-    while True:
-        check_for_notifications()
-        time.sleep(60)  # check every 60 seconds
+    if "--dry-run" in sys.argv[1:]:
+        dry_run()
+    else:
+        run()
@@ -0,0 +1,249 @@
+import os
+import sys
+from datetime import timedelta
+from psycopg2.extras import execute_values
+from Metrics import METRIC_FIELDS
+from config import get_db_conn
+from schema import column_exists
+
+# usage: python rollups.py [days]
+# Rebuilds hourly and daily rollups from raw metrics, for the last `days` days or everything.
+ROLLUP_METRICS = (*METRIC_FIELDS, "is_up")
+ROLLUP_TABLES = {"hour": "metrics_hourly", "day": "metrics_daily"}
+ROLLUP_PAGE_SIZE = 1000
+# Finished buckets get their p95 from the raw rows; ones older than this (raw rows may be gone) are left alone
+ROLLUP_CLOSE_LOOKBACK_DAYS = int(os.getenv("ROLLUP_CLOSE_LOOKBACK_DAYS", "3"))
+# percent_cap baselines: time-decayed mean per (url, metric). A decay constant of half the window
+# gives the same average sample age as a flat BASELINE_WINDOW_DAYS window.
+BASELINE_METRICS = METRIC_FIELDS
+BASELINE_WINDOW_DAYS = float(os.getenv("BASELINE_WINDOW_DAYS", "7"))
+BASELINE_TAU_SECONDS = BASELINE_WINDOW_DAYS * 86400 / 2
+
+ROLLUP_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        url_id INTEGER NOT NULL REFERENCES urls(id) ON DELETE CASCADE,
+        browser_id SMALLINT NOT NULL,
+        group_id INTEGER NOT NULL DEFAULT 0,
+        metric TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        count INTEGER NOT NULL,
+        min REAL,
+        max REAL,
+        mean DOUBLE PRECISION,
+        p95 REAL,
+        sum DOUBLE PRECISION,
+        sum_sq DOUBLE PRECISION,
+        PRIMARY KEY (url_id, browser_id, group_id, metric, bucket)
+    );
+'''
+
+
+def ensure_rollup_tables(cursor):
+    for table in ROLLUP_TABLES.values():
+        cursor.execute(ROLLUP_TABLE_SQL.format(table=table))
+        # Lets charts derive a standard deviation from buckets; NULL until a bucket is rebuilt
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS sum_sq DOUBLE PRECISION")
+        # Flushes add to sum rather than averaging means
+        if not column_exists(cursor, table, "sum"):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN sum DOUBLE PRECISION")
+            cursor.execute(f"UPDATE {table} SET sum = mean * count")
+        # Buckets still waiting for close_rollups()
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_open ON {table} (bucket) WHERE p95 IS NULL")
+    cursor.execute("SELECT to_regclass('metric_baselines') IS NULL")
+    is_new = cursor.fetchone()[0]
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metric_baselines (
+            url_id INTEGER NOT NULL REFERENCES urls(id) ON DELETE CASCADE,
+            metric TEXT NOT NULL,
+            weighted_sum DOUBLE PRECISION NOT NULL,
+            weight DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (url_id, metric)
+        );
+    ''')
+    if is_new:
+        seed_baselines(cursor)
+
+
+def seed_baselines(cursor):
+    # Rebuilt from the hourly rollups with each bucket already decayed to now; an empty table is seeded
+    # when created, and backfill() reseeds once the rollups hold the history
+    cursor.execute('''
+        INSERT INTO metric_baselines AS b (url_id, metric, weighted_sum, weight, updated_at)
+        SELECT url_id, metric,
+               SUM(sum * exp(-EXTRACT(EPOCH FROM LOCALTIMESTAMP - bucket) / %(tau)s)),
+               SUM(count * exp(-EXTRACT(EPOCH FROM LOCALTIMESTAMP - bucket) / %(tau)s)),
+               LOCALTIMESTAMP
+        FROM metrics_hourly
+        WHERE metric = ANY(%(metrics)s) AND bucket >= LOCALTIMESTAMP - make_interval(days => %(days)s)
+        GROUP BY url_id, metric
+        ON CONFLICT (url_id, metric) DO UPDATE SET
+            weighted_sum = EXCLUDED.weighted_sum, weight = EXCLUDED.weight, updated_at = EXCLUDED.updated_at
+    ''', {"tau": BASELINE_TAU_SECONDS, "metrics": list(BASELINE_METRICS), "days": int(BASELINE_WINDOW_DAYS * 4)})
+
+
+def update_baselines(cursor, samples):
+    # samples: (url_id, metric, value, timestamp). The stored sum and weight decay by the time since
+    # the last update and then take the new values, so each rule's baseline stays one row to read.
+    batch = {}
+    for url_id, metric, value, timestamp in samples:
+        if metric not in BASELINE_METRICS or value is None or value < 0:
+            continue
+        total, count, latest = batch.get((url_id, metric), (0.0, 0, timestamp))
+        batch[(url_id, metric)] = (total + value, count + 1, max(latest, timestamp))
+    if not batch:
+        return
+    execute_values(cursor, f'''
+        INSERT INTO metric_baselines AS b (url_id, metric, weighted_sum, weight, updated_at) VALUES %s
+        ON CONFLICT (url_id, metric) DO UPDATE SET
+            weighted_sum = b.weighted_sum * exp(-GREATEST(EXTRACT(EPOCH FROM EXCLUDED.updated_at - b.updated_at), 0)
+                                                / {BASELINE_TAU_SECONDS}) + EXCLUDED.weighted_sum,
+            weight = b.weight * exp(-GREATEST(EXTRACT(EPOCH FROM EXCLUDED.updated_at - b.updated_at), 0)
+                                    / {BASELINE_TAU_SECONDS}) + EXCLUDED.weight,
+            updated_at = GREATEST(b.updated_at, EXCLUDED.updated_at)
+    ''', [(url_id, metric, *stats) for (url_id, metric), stats in batch.items()],
+        template="(%s, %s, %s, %s, %s::timestamp)", page_size=ROLLUP_PAGE_SIZE)
+
+
+def raw_rollup_sql(unit):
+    # Every (url, browser, group, metric) bucket over [%(start)s, %(end)s) from the raw rows. Selected by time
+    # rather than joined on the series keys, so partition pruning narrows the scan.
+    # Negative values are the "not measured" marker clients send and are left out.
+    values = ", ".join(f"('{name}', m.{name}::float8)" for name in ROLLUP_METRICS)
+    return f"""
+        SELECT m.url_id, m.browser_id, COALESCE(m.group_id, 0) AS group_id, v.metric,
+               date_trunc('{unit}', m.timestamp) AS bucket, COUNT(*) AS count, MIN(v.value) AS min,
+               MAX(v.value) AS max, SUM(v.value) AS sum, SUM(v.value * v.value) AS sum_sq,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY v.value) AS p95
+        FROM metrics m
+        CROSS JOIN LATERAL (VALUES {values}) AS v(metric, value)
+        WHERE m.timestamp >= %(start)s AND m.timestamp < %(end)s AND m.browser_id IS NOT NULL AND v.value >= 0
+        GROUP BY 1, 2, 3, 4, 5
+    """
+
+
+def additive_upsert_sql(table):
+    # Adds one batch's partial aggregates to the stored ones. p95 can't be merged that way, so a touched
+    # bucket goes back to NULL until close_rollups() recomputes it.
+    return f"""
+        ON CONFLICT (url_id, browser_id, group_id, metric, bucket) DO UPDATE SET
+            count = {table}.count + EXCLUDED.count,
+            min = LEAST({table}.min, EXCLUDED.min),
+            max = GREATEST({table}.max, EXCLUDED.max),
+            sum = {table}.sum + EXCLUDED.sum,
+            sum_sq = {table}.sum_sq + EXCLUDED.sum_sq,
+            mean = ({table}.sum + EXCLUDED.sum) / ({table}.count + EXCLUDED.count),
+            p95 = NULL
+    """
+
+
+UPDATE_ROLLUPS_SQL = f"""
+    WITH batch AS (
+        SELECT s.url_id, s.browser_id, s.group_id, v.metric, date_trunc('hour', s.ts) AS bucket,
+               COUNT(*) AS count, MIN(v.value) AS min, MAX(v.value) AS max,
+               SUM(v.value) AS sum, SUM(v.value * v.value) AS sum_sq
+        FROM (VALUES %s) AS s(url_id, browser_id, group_id, ts, {", ".join(ROLLUP_METRICS)})
+        CROSS JOIN LATERAL (VALUES {", ".join(f"('{name}', s.{name})" for name in ROLLUP_METRICS)}) AS v(metric, value)
+        WHERE v.value >= 0
+        GROUP BY 1, 2, 3, 4, 5
+    ), hourly AS (
+        INSERT INTO metrics_hourly (url_id, browser_id, group_id, metric, bucket, count, min, max, sum, sum_sq, mean)
+        SELECT *, sum / count FROM batch
+        {additive_upsert_sql("metrics_hourly")}
+    )
+    INSERT INTO metrics_daily (url_id, browser_id, group_id, metric, bucket, count, min, max, sum, sum_sq, mean)
+    SELECT url_id, browser_id, group_id, metric, date_trunc('day', bucket), SUM(count), MIN(min), MAX(max),
+           SUM(sum), SUM(sum_sq), SUM(sum) / SUM(count)
+    FROM batch
+    GROUP BY 1, 2, 3, 4, 5
+    {additive_upsert_sql("metrics_daily")}
+"""
+
+
+def update_rollups(cursor, rows):
+    # rows: (url_id, browser_id, group_id, timestamp, *ROLLUP_METRICS) of freshly written measurements.
+    # Each page is aggregated into hourly partials once, and the daily partials are summed from those.
+    rows = [(url_id, browser_id, group_id or 0, *rest)
+            for url_id, browser_id, group_id, *rest in rows if browser_id is not None]
+    if not rows:
+        return
+    template = "(%s, %s::smallint, %s::integer, %s::timestamp" + ", %s::float8" * len(ROLLUP_METRICS) + ")"
+    execute_values(cursor, UPDATE_ROLLUPS_SQL, rows, template=template, page_size=ROLLUP_PAGE_SIZE)
+
+
+def fill_p95(cursor, unit, start, end):
+    table = ROLLUP_TABLES[unit]
+    cursor.execute(f"""
+        UPDATE {table} r SET p95 = a.p95
+        FROM ({raw_rollup_sql(unit)}) AS a
+        WHERE r.url_id = a.url_id AND r.browser_id = a.browser_id AND r.group_id = a.group_id
+          AND r.metric = a.metric AND r.bucket = a.bucket
+    """, {"start": start, "end": end})
+
+
+def close_rollups(cursor):
+    # Fills in p95 for finished buckets that flushes have touched since it was last computed
+    closed = []
+    for unit, table in ROLLUP_TABLES.items():
+        cursor.execute(f"""
+            SELECT DISTINCT bucket FROM {table}
+            WHERE p95 IS NULL AND bucket < date_trunc('{unit}', LOCALTIMESTAMP)
+              AND bucket >= LOCALTIMESTAMP - make_interval(days => %s)
+            ORDER BY bucket
+        """, (ROLLUP_CLOSE_LOOKBACK_DAYS,))
+        for (bucket,) in cursor.fetchall():
+            fill_p95(cursor, unit, bucket, bucket + (timedelta(hours=1) if unit == "hour" else timedelta(days=1)))
+            closed.append(f"{table} {bucket:%Y-%m-%d %H:%M}")
+    return closed
+
+
+def backfill_range(cursor, start, end):
+    # Hourly buckets from the raw rows, then daily ones summed from those; p95 needs the raw rows for both
+    cursor.execute(f"""
+        INSERT INTO metrics_hourly (url_id, browser_id, group_id, metric, bucket, count, min, max, sum, sum_sq, mean, p95)
+        SELECT url_id, browser_id, group_id, metric, bucket, count, min, max, sum, sum_sq, sum / count, p95
+        FROM ({raw_rollup_sql("hour")}) AS a
+        ON CONFLICT (url_id, browser_id, group_id, metric, bucket) DO UPDATE SET
+            count = EXCLUDED.count, min = EXCLUDED.min, max = EXCLUDED.max, sum = EXCLUDED.sum,
+            sum_sq = EXCLUDED.sum_sq, mean = EXCLUDED.mean, p95 = EXCLUDED.p95
+    """, {"start": start, "end": end})
+    cursor.execute("""
+        INSERT INTO metrics_daily (url_id, browser_id, group_id, metric, bucket, count, min, max, sum, sum_sq, mean)
+        SELECT url_id, browser_id, group_id, metric, date_trunc('day', bucket), SUM(count), MIN(min), MAX(max),
+               SUM(sum), SUM(sum_sq), SUM(sum) / SUM(count)
+        FROM metrics_hourly
+        WHERE bucket >= %(start)s AND bucket < %(end)s
+        GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT (url_id, browser_id, group_id, metric, bucket) DO UPDATE SET
+            count = EXCLUDED.count, min = EXCLUDED.min, max = EXCLUDED.max, sum = EXCLUDED.sum,
+            sum_sq = EXCLUDED.sum_sq, mean = EXCLUDED.mean
+    """, {"start": start, "end": end})
+    fill_p95(cursor, "day", start, end)
+
+
+def backfill(days=None):
+    # One day per transaction, so a long backfill makes steady progress and holds no long locks
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        ensure_rollup_tables(cursor)
+        conn.commit()
+        cursor.execute("""
+            SELECT date_trunc('day', GREATEST(MIN(timestamp), LOCALTIMESTAMP - make_interval(days => %s))),
+                   MAX(timestamp)
+            FROM metrics
+        """, (days if days is not None else 36500,))
+        start, last = cursor.fetchone()
+        conn.commit()
+        while last is not None and start <= last:
+            end = start + timedelta(days=1)
+            backfill_range(cursor, start, end)
+            conn.commit()
+            print(f"[ROLLUP] Rebuilt {start:%Y-%m-%d}")
+            start = end
+        seed_baselines(cursor)
+        conn.commit()
+        print("[ROLLUP] Reseeded baselines")
+
+
+if __name__ == "__main__":
+    backfill(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import threading
+import time
+
+DEFAULT_CHECK_INTERVAL = 300
+REFRESH_OVERLAP_SECONDS = 5
+NO_GROUP = 0
+
+
+class GroupQueue:
+    """Per-group due times. Entries wait in `waiting` (keyed by due time) until they are due,
+    then move to `ready` (keyed by priority, then due time)."""
+
+    def __init__(self):
+        self.waiting = []  # (due, seq, url_id)
+        self.ready = []  # (-priority, due, seq, url_id)
+        self.entries = {}
+        self.assigned = 0
+
+
+class UrlScheduler:
+    """Schedules (url, client group) pairs so every group measures every active URL on its own interval."""
+
+    def __init__(self):
+        self.urls = {}
+        self.active = 0
+        self.groups = {}
+        self.watermark = None
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+
+    def _due(self, url_id, entry):
+        return entry["last_checked"] + (self.urls[url_id]["interval"] or DEFAULT_CHECK_INTERVAL)
+
+    def _push(self, queue, url_id, entry, due=None):
+        entry["seq"] = next(self.seq)
+        entry["due"] = self._due(url_id, entry) if due is None else due
+        if self.urls[url_id]["active"] and entry["lease_id"] is None:
+            heapq.heappush(queue.waiting, (entry["due"], entry["seq"], url_id))
+
+    def _valid(self, queue, seq, url_id):
+        entry = queue.entries.get(url_id)
+        return (entry is not None and entry["seq"] == seq and entry["lease_id"] is None
+                and self.urls[url_id]["active"])
+
+    def _promote(self, queue, now):
+        while queue.waiting and queue.waiting[0][0] <= now:
+            due, seq, url_id = heapq.heappop(queue.waiting)
+            if self._valid(queue, seq, url_id):
+                heapq.heappush(queue.ready, (-self.urls[url_id]["priority"], due, seq, url_id))
+
+    def _entry(self, queue, url_id, last_checked=0):
+        entry = queue.entries.get(url_id)
+        if entry is None:
+            entry = {"last_checked": last_checked, "lease_id": None}
+            queue.entries[url_id] = entry
+        return entry
+
+    def refresh(self, cursor):
+        # Only rows touched since the last refresh are read, with a small overlap for late commits
+        query = """
+            SELECT id, url, check_interval, priority, referenced > 0 AND forceInactive = 0, updated_at
+            FROM urls
+        """
+        if self.watermark is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query + " WHERE updated_at >= %s - make_interval(secs => %s)",
+                           (self.watermark, REFRESH_OVERLAP_SECONDS))
+        rows = cursor.fetchall()
+        with self.lock:
+            for url_id, url, interval, priority, active, updated_at in rows:
+                previous = self.urls.get(url_id)
+                self.active += bool(active) - bool(previous and previous["active"])
+                self.urls[url_id] = {"url": url, "interval": interval, "priority": priority or 0, "active": active}
+                for queue in self.groups.values():
+                    self._push(queue, url_id, self._entry(queue, url_id))
+                if updated_at and (self.watermark is None or updated_at > self.watermark):
+                    self.watermark = updated_at
+        return len(rows)
+
+    def remove(self, url_id):
+        # For URLs deleted from the database; refresh() only sees rows that still exist.
+        # Heap items left behind fail _valid() and are dropped when they surface.
+        with self.lock:
+            previous = self.urls.pop(url_id, None)
+            if previous is None:
+                return
+            self.active -= bool(previous["active"])
+            for queue in self.groups.values():
+                queue.entries.pop(url_id, None)
+
+    def has_group(self, group_id):
+        with self.lock:
+            return group_id in self.groups
+
+    def load_group(self, cursor, group_id):
+        # Ages are computed by the database so its clock and time zone don't matter here
+        cursor.execute("""
+            SELECT url_id, EXTRACT(EPOCH FROM LOCALTIMESTAMP - last_checked)
+            FROM url_group_schedule WHERE group_id = %s
+        """, (group_id,))
+        now = time.time()
+        checked = {url_id: now - float(age) for url_id, age in cursor.fetchall() if age is not None}
+        with self.lock:
+            if group_id in self.groups:
+                return
+            queue = GroupQueue()
+            for url_id in self.urls:
+                self._push(queue, url_id, self._entry(queue, url_id, checked.get(url_id, 0)))
+            self.groups[group_id] = queue
+
+    def acquire(self, group_id, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            queue = self.groups[group_id]
+            self._promote(queue, now)
+            while queue.ready:
+                _, _, seq, url_id = heapq.heappop(queue.ready)
+                if self._valid(queue, seq, url_id):
+                    queue.entries[url_id]["lease_id"] = -1
+                    queue.assigned += 1
+                    return url_id, self.urls[url_id]["url"]
+        return None
+
+    def assign(self, url_id, group_id, lease_id):
+        with self.lock:
+            self.groups[group_id].entries[url_id]["lease_id"] = lease_id
+
+    def complete(self, url_id, group_id, lease_id, checked_at=None):
+        checked_at = time.time() if checked_at is None else checked_at
+        with self.lock:
+            queue = self.groups.get(group_id)
+            if queue is None or url_id not in queue.entries:
+                return
+            entry = queue.entries[url_id]
+            entry["last_checked"] = max(entry["last_checked"], checked_at)
+            if entry["lease_id"] == lease_id:
+                entry["lease_id"] = None
+                self._push(queue, url_id, entry)
+
+    def requeue(self, url_id, group_id, lease_id=None, delay=0):
+        now = time.time()
+        with self.lock:
+            queue = self.groups.get(group_id)
+            entry = queue.entries.get(url_id) if queue else None
+            if entry is None or (lease_id is not None and entry["lease_id"] != lease_id):
+                return
+            entry["lease_id"] = None
+            # Released work is due again right away (or after the given delay), whatever its interval
+            self._push(queue, url_id, entry, now + delay)
+
+    def seconds_until_due(self, group_id, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            queue = self.groups[group_id]
+            self._promote(queue, now)
+            while queue.ready and not self._valid(queue, queue.ready[0][2], queue.ready[0][3]):
+                heapq.heappop(queue.ready)
+            if queue.ready:
+                return 0.0
+            while queue.waiting:
+                due, seq, url_id = queue.waiting[0]
+                if self._valid(queue, seq, url_id):
+                    return max(0.0, due - now)
+                heapq.heappop(queue.waiting)
+        return None
+
+    def staleness(self, now=None):
+        # (url, group_id, seconds since last check) for every active URL in every loaded group
+        now = time.time() if now is None else now
+        with self.lock:
+            return [
+                (self.urls[url_id]["url"], group_id, now - entry["last_checked"] if entry["last_checked"] else None)
+                for group_id, queue in self.groups.items()
+                for url_id, entry in queue.entries.items()
+                if self.urls[url_id]["active"]
+            ]
+
+    def active_count(self):
+        return self.active
@@ -0,0 +1,301 @@
+import re
+from datetime import datetime, timedelta
+from config import (
+    METRICS_PARTITION_UNIT, METRICS_PARTITIONS_AHEAD, METRICS_RETENTION_DAYS, METRICS_RETENTION_ACTION
+)
+from Metrics import NOTIFICATION_TYPES
+
+METRIC_TABLE_COLUMNS = (
+    "id", "url_id", "browser_id", "group_id", "timestamp", "is_up",
+    "load_time", "memory_usage", "cpu_time", "dom_nodes", "total_page_size",
+    "fcp", "network_requests", "script_size", "broken_link_count"
+)
+METRICS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS metrics (
+        id BIGINT NOT NULL DEFAULT nextval('metrics_id_seq'),
+        url_id INTEGER NOT NULL REFERENCES urls(id) ON DELETE CASCADE,
+        browser_id SMALLINT,
+        group_id INTEGER,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        is_up SMALLINT,
+        load_time REAL,
+        memory_usage REAL,
+        cpu_time REAL,
+        dom_nodes INTEGER,
+        total_page_size REAL,
+        fcp REAL,
+        network_requests INTEGER,
+        script_size REAL,
+        broken_link_count INTEGER,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+'''
+PARTITION_UNITS = ("day", "week", "month")
+PARTITION_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+CHECK_LITERAL_RE = re.compile(r"'([^']*)'")
+
+
+def column_exists(cursor, table, column):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+
+def migrate_legacy_metrics(cursor):
+    # Older installs stored the full URL as TEXT on every row and broken links as one comma-joined string
+    print("[SCHEMA] Migrating metrics to url_id keys...")
+    cursor.execute("""
+        INSERT INTO urls (url)
+        SELECT DISTINCT url FROM metrics WHERE url IS NOT NULL
+        ON CONFLICT (url) DO NOTHING
+    """)
+    cursor.execute("ALTER TABLE metrics ADD COLUMN IF NOT EXISTS url_id INTEGER")
+    cursor.execute("UPDATE metrics m SET url_id = u.id FROM urls u WHERE u.url = m.url")
+    cursor.execute("DELETE FROM metrics WHERE url_id IS NULL")
+    # One ALTER so the table is rewritten once; rows without a real group were stored as -1 or 0
+    cursor.execute("""
+        ALTER TABLE metrics
+            ALTER COLUMN id TYPE BIGINT,
+            ALTER COLUMN url_id SET NOT NULL,
+            ALTER COLUMN browser_id TYPE SMALLINT,
+            ALTER COLUMN is_up TYPE SMALLINT,
+            ALTER COLUMN group_id TYPE INTEGER USING CASE WHEN group_id > 0 THEN group_id END,
+            ALTER COLUMN broken_links TYPE TEXT[] USING string_to_array(NULLIF(broken_links, ''), ', '),
+            ADD CONSTRAINT metrics_url_id_fkey FOREIGN KEY (url_id) REFERENCES urls(id) ON DELETE CASCADE,
+            DROP COLUMN url
+    """)
+    cursor.execute("ALTER SEQUENCE IF EXISTS metrics_id_seq AS BIGINT")
+
+
+def ensure_broken_links_table(cursor):
+    # One row per (page, broken link) instead of the full list on every metrics row
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broken_links (
+            url_id INTEGER NOT NULL REFERENCES urls(id) ON DELETE CASCADE,
+            link TEXT NOT NULL,
+            first_seen TIMESTAMP NOT NULL,
+            last_seen TIMESTAMP NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (url_id, link)
+        );
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broken_links_first_seen ON broken_links (url_id, first_seen)")
+
+
+def migrate_broken_link_lists(cursor):
+    print("[SCHEMA] Moving broken links out of metrics rows...")
+    cursor.execute("""
+        INSERT INTO broken_links (url_id, link, first_seen, last_seen, hits)
+        SELECT m.url_id, l.link, MIN(m.timestamp), MAX(m.timestamp), COUNT(*)
+        FROM metrics m CROSS JOIN LATERAL unnest(m.broken_links) AS l(link)
+        WHERE m.timestamp IS NOT NULL
+        GROUP BY m.url_id, l.link
+        ON CONFLICT (url_id, link) DO NOTHING
+    """)
+    cursor.execute("ALTER TABLE metrics ADD COLUMN IF NOT EXISTS broken_link_count INTEGER")
+    cursor.execute("UPDATE metrics SET broken_link_count = COALESCE(cardinality(broken_links), 0)")
+    cursor.execute("ALTER TABLE metrics DROP COLUMN broken_links")
+
+
+def ensure_notifications_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id),
+            url_id INTEGER REFERENCES urls(id),
+            metric TEXT,
+            type TEXT,
+            threshold REAL,
+            last_value REAL,
+            email TEXT
+        );
+    ''')
+    cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS last_notified TIMESTAMP")
+    cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS active BOOLEAN DEFAULT TRUE")
+    cursor.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS window_size INTEGER")
+    # The type list grows with new rule types, so the check is replaced when it names a different set.
+    # Replacing it rescans the table under an exclusive lock, so an unchanged check is left alone.
+    cursor.execute("""
+        SELECT pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = 'notifications'::regclass AND conname = 'notifications_type_check'
+    """)
+    row = cursor.fetchone()
+    if row is not None and set(CHECK_LITERAL_RE.findall(row[0])) == set(NOTIFICATION_TYPES):
+        return
+    types = ", ".join(f"'{notif_type}'" for notif_type in NOTIFICATION_TYPES)
+    cursor.execute("ALTER TABLE notifications DROP CONSTRAINT IF EXISTS notifications_type_check")
+    cursor.execute(f"ALTER TABLE notifications ADD CONSTRAINT notifications_type_check CHECK (type IN ({types}))")
+
+
+def ensure_latest_metrics_table(cursor):
+    # Newest row per (url, browser, group), so current-status reads never touch history
+    cursor.execute("SELECT to_regclass('latest_metrics') IS NULL")
+    is_new = cursor.fetchone()[0]
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS latest_metrics (
+            url_id INTEGER NOT NULL REFERENCES urls(id) ON DELETE CASCADE,
+            browser_id SMALLINT NOT NULL,
+            group_id INTEGER NOT NULL DEFAULT 0,
+            timestamp TIMESTAMP NOT NULL,
+            is_up SMALLINT,
+            load_time REAL,
+            memory_usage REAL,
+            cpu_time REAL,
+            dom_nodes INTEGER,
+            total_page_size REAL,
+            fcp REAL,
+            network_requests INTEGER,
+            script_size REAL,
+            broken_link_count INTEGER,
+            PRIMARY KEY (url_id, browser_id, group_id)
+        );
+    ''')
+    if is_new:
+        columns = ", ".join(METRIC_TABLE_COLUMNS[1:])
+        cursor.execute(f"""
+            INSERT INTO latest_metrics ({columns})
+            SELECT DISTINCT ON (url_id, browser_id, COALESCE(group_id, 0))
+                {columns.replace("group_id", "COALESCE(group_id, 0)")}
+            FROM metrics WHERE browser_id IS NOT NULL
+            ORDER BY url_id, browser_id, COALESCE(group_id, 0), timestamp DESC
+        """)
+
+
+def next_boundary(start, unit):
+    if unit == "day":
+        return start + timedelta(days=1)
+    if unit == "week":
+        return start + timedelta(days=7)
+    return (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def metrics_partitions(cursor):
+    # (name, start, end) of every range partition, oldest first; the default partition is left out
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'metrics'::regclass
+    """)
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = PARTITION_BOUND_RE.search(bound or "")
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_metrics_partition(cursor, start, end):
+    name = f"metrics_p{start:%Y%m%d}"
+    bounds = (start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S"))
+    cursor.execute(f"CREATE TABLE {name} (LIKE metrics INCLUDING DEFAULTS)")
+    # Rows that landed in the default partition for this range move over, or ATTACH would refuse
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM metrics_default WHERE timestamp >= %s AND timestamp < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """, bounds)
+    cursor.execute(f"ALTER TABLE metrics ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+    return name
+
+
+def ensure_metrics_partitions(cursor, unit=METRICS_PARTITION_UNIT, ahead=METRICS_PARTITIONS_AHEAD, since=None):
+    # Partitions from `since` (default: the current period) through `ahead` periods into the future
+    if unit not in PARTITION_UNITS:
+        raise ValueError(f"METRICS_PARTITION_UNIT must be one of {PARTITION_UNITS}, got {unit!r}")
+    cursor.execute("SELECT date_trunc(%s, COALESCE(%s, LOCALTIMESTAMP)), date_trunc(%s, LOCALTIMESTAMP)",
+                   (unit, since, unit))
+    start, current = cursor.fetchone()
+    last = current
+    for _ in range(ahead):
+        last = next_boundary(last, unit)
+    existing = metrics_partitions(cursor)
+    created = []
+    while start <= last:
+        end = next_boundary(start, unit)
+        # After a unit change, periods overlapping older partitions are skipped; the default catches the gap
+        if not any(lo < end and start < hi for _, lo, hi in existing):
+            created.append(create_metrics_partition(cursor, start, end))
+        start = end
+    return created
+
+
+def apply_metrics_retention(cursor, retention_days=METRICS_RETENTION_DAYS, action=METRICS_RETENTION_ACTION):
+    # Whole partitions go at once, so there is no DELETE churn or vacuum debt on the live table
+    if retention_days <= 0:
+        return []
+    if action not in ("drop", "archive"):
+        raise ValueError(f"METRICS_RETENTION_ACTION must be 'drop' or 'archive', got {action!r}")
+    cursor.execute("SELECT LOCALTIMESTAMP - make_interval(days => %s)", (retention_days,))
+    cutoff = cursor.fetchone()[0]
+    expired = []
+    for name, _, end in metrics_partitions(cursor):
+        if end > cutoff:
+            continue
+        if action == "archive":
+            cursor.execute(f"ALTER TABLE metrics DETACH PARTITION {name}")
+            cursor.execute(f"ALTER TABLE {name} RENAME TO archived_{name}")
+        else:
+            cursor.execute(f"DROP TABLE {name}")
+        expired.append(name)
+    cursor.execute("DELETE FROM metrics_default WHERE timestamp < %s", (cutoff,))
+    return expired
+
+
+def metrics_table_exists(cursor):
+    cursor.execute("SELECT to_regclass('metrics') IS NOT NULL")
+    return cursor.fetchone()[0]
+
+
+def metrics_needs_migration(cursor):
+    # True on installs the server hasn't converted yet: metrics still keyed by URL text, or no latest_metrics
+    cursor.execute("SELECT to_regclass('latest_metrics') IS NULL")
+    if cursor.fetchone()[0]:
+        return True
+    return not column_exists(cursor, "metrics", "url_id")
+
+
+def ensure_metrics_table(cursor):
+    # Needs urls to exist first. Converting an old install rewrites every row, so only the server runs this
+    # against an existing table; other tools check metrics_table_exists() first.
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('metrics')")
+    row = cursor.fetchone()
+    unpartitioned = row is not None and row[0] == "r"
+    ensure_broken_links_table(cursor)
+    if unpartitioned and column_exists(cursor, "metrics", "url"):
+        migrate_legacy_metrics(cursor)
+    if row is not None and column_exists(cursor, "metrics", "broken_links"):
+        migrate_broken_link_lists(cursor)
+    if unpartitioned:
+        print("[SCHEMA] Moving metrics into a time-partitioned table...")
+        cursor.execute("ALTER TABLE metrics RENAME TO metrics_unpartitioned")
+        for index in ("metrics_pkey", "idx_metrics_series", "idx_metrics_url_time"):
+            cursor.execute(f"ALTER INDEX IF EXISTS {index} RENAME TO {index.replace('metrics', 'metrics_unpartitioned', 1)}")
+
+    cursor.execute("CREATE SEQUENCE IF NOT EXISTS metrics_id_seq AS BIGINT")
+    cursor.execute(METRICS_TABLE_SQL)
+    cursor.execute("ALTER SEQUENCE metrics_id_seq OWNED BY metrics.id")
+    cursor.execute("CREATE TABLE IF NOT EXISTS metrics_default PARTITION OF metrics DEFAULT")
+    # Retention and new partitions clear the default partition by time range
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_metrics_default_time ON metrics_default (timestamp)")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_metrics_series
+        ON metrics (url_id, browser_id, group_id, timestamp)
+    """)
+    # Alert checks read every browser of a URL over a recent window
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_metrics_url_time ON metrics (url_id, timestamp)")
+
+    if unpartitioned:
+        cursor.execute("SELECT MIN(timestamp) FROM metrics_unpartitioned")
+        ensure_metrics_partitions(cursor, since=cursor.fetchone()[0])
+        columns = ", ".join(METRIC_TABLE_COLUMNS)
+        cursor.execute(f"""
+            INSERT INTO metrics ({columns})
+            SELECT {columns.replace("timestamp", "COALESCE(timestamp, '1970-01-01')")} FROM metrics_unpartitioned
+        """)
+        cursor.execute("DROP TABLE metrics_unpartitioned")
+    else:
+        ensure_metrics_partitions(cursor)
+    ensure_latest_metrics_table(cursor)
@@ -1,44 +1,71 @@
 import os
-import socket
+import time
+import asyncio
+import functools
 import psycopg2
 import requests
 import threading
-from Metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+from Metrics import Metrics, METRIC_FIELDS
 from datetime import datetime
-from networkutils import DynamicClientSocket, HandshakeSocket
-from config import get_db_conn, HANDSHAKE_PORT
+from scheduler import UrlScheduler, NO_GROUP
+from ingestion import IngestionQueue
+from networkutils import AsyncJsonSocket
+from telemetry import Histogram, RateWindow, MetricsRegistry, start_metrics_server
+from schema import ensure_metrics_table, ensure_metrics_partitions, apply_metrics_retention
+from rollups import ensure_rollup_tables, update_rollups, close_rollups, update_baselines, ROLLUP_METRICS, BASELINE_METRICS
+from config import get_db_conn, db_pool_stats, HANDSHAKE_PORT, DB_POOL_MAX, METRICS_CHANNEL
 from dotenv import load_dotenv
 
 
 load_dotenv()
 HOST = os.getenv('SERVER_IP')
 PERMANENT_PORT = HANDSHAKE_PORT
-shutdown_event = threading.Event()
-clients_threads = []
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "600"))
+LEASE_SWEEP_INTERVAL = int(os.getenv("LEASE_SWEEP_INTERVAL", "30"))
+LEASE_POLL_INTERVAL = int(os.getenv("LEASE_POLL_INTERVAL", "5"))
+SCHEDULER_REFRESH_INTERVAL = int(os.getenv("SCHEDULER_REFRESH_INTERVAL", "5"))
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+# How often finished rollup buckets get their p95 filled in
+ROLLUP_CLOSE_INTERVAL = int(os.getenv("ROLLUP_CLOSE_INTERVAL", "300"))
+DYNAMIC_ACCEPT_TIMEOUT = int(os.getenv("DYNAMIC_ACCEPT_TIMEOUT", "30"))
+# A connected client that hasn't introduced itself within this many seconds is dropped, freeing its session
+HELLO_TIMEOUT = int(os.getenv("HELLO_TIMEOUT", "30"))
+HANDSHAKE_BACKLOG = int(os.getenv("HANDSHAKE_BACKLOG", "1024"))
+SHUTDOWN_GRACE_SECONDS = int(os.getenv("SHUTDOWN_GRACE_SECONDS", "60"))
+INGEST_MAX_ROWS = int(os.getenv("INGEST_MAX_ROWS", "10000"))
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "500"))
+INGEST_FLUSH_SECONDS = float(os.getenv("INGEST_FLUSH_SECONDS", "1.0"))
+MAX_MESSAGE_BYTES = int(os.getenv("MAX_MESSAGE_BYTES", str(16 * 1024 * 1024)))
+# Admission limits: over them, clients are told to retry later instead of piling up
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "2000"))
+MAX_INFLIGHT_ASSIGNMENTS = int(os.getenv("MAX_INFLIGHT_ASSIGNMENTS", "1000"))
+MAX_PENDING_INGEST_BYTES = int(os.getenv("MAX_PENDING_INGEST_BYTES", str(64 * 1024 * 1024)))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "10"))
+# Prometheus-style text endpoint; local only by default, 0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+shutdown_event = asyncio.Event()
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+client_tasks = set()
+background_tasks = set()
+ack_tasks = set()
+ingestion = None
+session_stats = {"connected": 0, "peak_connected": 0, "assignments": 0, "bytes_received": 0}
+admission_stats = {"reserved_sessions": 0, "inflight": 0, "rejected_sessions": 0, "deferred_assignments": 0}
+scheduler = UrlScheduler()
+# Updated from run_db worker threads, so always through count_lease()
+lease_stats = {"granted": 0, "completed": 0, "released": 0, "expired": 0, "rows": 0}
+lease_stats_lock = threading.Lock()
+insert_latency = Histogram()
+assignment_rate = RateWindow()
+bytes_rate = RateWindow()
 
 
 def initialize_databases():
     conn = get_db_conn()
     cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS metrics (
-            id SERIAL PRIMARY KEY,
-            url TEXT,
-            load_time REAL,
-            memory_usage REAL,
-            cpu_time REAL,
-            dom_nodes INTEGER,
-            total_page_size REAL,
-            fcp REAL,
-            network_requests INTEGER,
-            script_size REAL,
-            broken_links TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            browser_id INTEGER,
-            is_up INTEGER,
-            group_id INTEGER
-        )
-    ''')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS urls (
             id SERIAL PRIMARY KEY,
@@ -48,12 +75,71 @@ def initialize_databases():
             forceInactive INTEGER DEFAULT 0
         );
     ''')
+    ensure_metrics_table(cursor)
+    ensure_rollup_tables(cursor)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS node_role (
             role TEXT CHECK(role IN ('client', 'server')) NOT NULL,
             active INTEGER DEFAULT 1 CHECK (active IN (0,1))
         );
     ''')
+    # Leases now live per (url, group) in url_group_schedule
+    cursor.execute("ALTER TABLE urls DROP COLUMN IF EXISTS lease_id")
+    cursor.execute("ALTER TABLE urls DROP COLUMN IF EXISTS lease_expires")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS url_leases (
+            id SERIAL PRIMARY KEY,
+            url_id INTEGER REFERENCES urls(id) ON DELETE CASCADE,
+            client TEXT,
+            leased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            status TEXT DEFAULT 'active' CHECK (status IN ('active', 'completed', 'released', 'expired')),
+            rows_ingested INTEGER DEFAULT 0
+        );
+    ''')
+    cursor.execute("ALTER TABLE url_leases ADD COLUMN IF NOT EXISTS group_id INTEGER DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_url_leases_active ON url_leases (expires_at) WHERE status = 'active'")
+    cursor.execute("SELECT to_regclass('url_group_schedule') IS NULL")
+    schedule_is_new = cursor.fetchone()[0]
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS url_group_schedule (
+            url_id INTEGER REFERENCES urls(id) ON DELETE CASCADE,
+            group_id INTEGER DEFAULT 0,
+            last_checked TIMESTAMP DEFAULT '1970-01-01 00:00:00',
+            lease_id INTEGER,
+            lease_expires TIMESTAMP,
+            PRIMARY KEY (url_id, group_id)
+        );
+    ''')
+    if schedule_is_new:
+        # Seed per-group due times from the measurements each group already has
+        cursor.execute('''
+            INSERT INTO url_group_schedule (url_id, group_id, last_checked)
+            SELECT u.id, CASE WHEN m.group_id > 0 THEN m.group_id ELSE 0 END, MAX(m.timestamp)
+            FROM metrics m JOIN urls u ON u.id = m.url_id
+            GROUP BY 1, 2
+            ON CONFLICT DO NOTHING
+        ''')
+    cursor.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS check_interval INTEGER DEFAULT 300")
+    cursor.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0")
+    cursor.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_urls_updated_at ON urls (updated_at)")
+    # The scheduler refreshes from rows whose scheduling inputs changed; lease and last_checked writes don't count
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION touch_urls_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = clock_timestamp();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+    cursor.execute("DROP TRIGGER IF EXISTS urls_touch_updated_at ON urls")
+    cursor.execute('''
+        CREATE TRIGGER urls_touch_updated_at
+        BEFORE INSERT OR UPDATE OF url, referenced, forceInactive, check_interval, priority ON urls
+        FOR EACH ROW EXECUTE FUNCTION touch_urls_updated_at();
+    ''')
     conn.commit()
     conn.close()
 
@@ -69,54 +155,306 @@ def validate_server_role():
         exit(1)
 
 
-def insert_metrics(metrics):
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO metrics (
-            url, load_time, memory_usage, cpu_time, dom_nodes,
-            total_page_size, fcp, network_requests, script_size,
-            broken_links, timestamp, browser_id, is_up, group_id
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (
-        metrics.url,
-        getattr(metrics, 'load_time', None),
-        getattr(metrics, 'memory_usage', None),
-        getattr(metrics, 'cpu_time', None),
-        getattr(metrics, 'dom_nodes', None),
-        getattr(metrics, 'total_page_size', None),
-        getattr(metrics, 'fcp', None),
-        getattr(metrics, 'network_requests', None),
-        getattr(metrics, 'script_size', None),
-        ', '.join(metrics.broken_links) if getattr(metrics, 'broken_links', None) else None,
-        getattr(metrics, 'timestamp', datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-        getattr(metrics, 'browser_id', None),
-        getattr(metrics, 'is_up', None),
-        getattr(metrics, 'group_id', None)
-    ))
-    conn.commit()
-    conn.close()
-
-
-def get_oldest_url():
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT url FROM urls
-        WHERE referenced > 0 AND forceInactive = 0
-        ORDER BY last_checked ASC LIMIT 1
-    """)
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
+METRIC_COLUMNS = (
+    "url_id", *METRIC_FIELDS, "broken_link_count",
+    "timestamp", "browser_id", "is_up", "group_id"
+)
+INSERT_METRICS_SQL = f"INSERT INTO metrics ({', '.join(METRIC_COLUMNS)}) VALUES %s"
+INSERT_PAGE_SIZE = int(os.getenv("INSERT_PAGE_SIZE", "500"))
+ROLLUP_KEY = tuple(METRIC_COLUMNS.index(name) for name in ("url_id", "browser_id", "group_id", "timestamp"))
+ROLLUP_COLUMNS = ROLLUP_KEY + tuple(METRIC_COLUMNS.index(name) for name in ROLLUP_METRICS)
+BASELINE_COLUMNS = tuple((name, METRIC_COLUMNS.index(name)) for name in BASELINE_METRICS)
+
+
+def broken_links_of(metrics):
+    # None when the client could not check links (sent as None, which Metrics turns into -1)
+    links = getattr(metrics, 'broken_links', None)
+    return links if isinstance(links, list) else None
+
+
+def write_broken_links(cursor, items, timestamps):
+    # Folds every sighting in the batch into one upsert row per (url_id, link)
+    seen = {}
+    for (url_id, metrics), timestamp in zip(items, timestamps):
+        for link in broken_links_of(metrics) or ():
+            first, last, hits = seen.get((url_id, link), (timestamp, timestamp, 0))
+            seen[(url_id, link)] = (min(first, timestamp), max(last, timestamp), hits + 1)
+    if seen:
+        execute_values(cursor, """
+            INSERT INTO broken_links (url_id, link, first_seen, last_seen, hits) VALUES %s
+            ON CONFLICT (url_id, link) DO UPDATE SET
+                first_seen = LEAST(broken_links.first_seen, EXCLUDED.first_seen),
+                last_seen = GREATEST(broken_links.last_seen, EXCLUDED.last_seen),
+                hits = broken_links.hits + EXCLUDED.hits
+        """, [(url_id, link, *stats) for (url_id, link), stats in seen.items()],
+            template="(%s, %s, %s::timestamp, %s::timestamp, %s)", page_size=INSERT_PAGE_SIZE)
+
+
+LATEST_UPDATE_SQL = ", ".join(
+    f"{name} = EXCLUDED.{name}" for name in METRIC_COLUMNS if name not in ("url_id", "browser_id", "group_id")
+)
+
+
+def write_latest_metrics(cursor, rows):
+    # Keeps only the newest row per (url_id, browser_id, group_id); older stragglers don't overwrite it
+    url, browser, group, ts = ROLLUP_KEY
+    latest = {}
+    for row in rows:
+        if row[browser] is None:
+            continue
+        row = list(row)
+        row[group] = row[group] or 0
+        row_key = (row[url], row[browser], row[group])
+        if row_key not in latest or latest[row_key][ts] <= row[ts]:
+            latest[row_key] = row
+    if latest:
+        execute_values(cursor, f"""
+            INSERT INTO latest_metrics ({', '.join(METRIC_COLUMNS)}) VALUES %s
+            ON CONFLICT (url_id, browser_id, group_id) DO UPDATE SET {LATEST_UPDATE_SQL}
+            WHERE latest_metrics.timestamp <= EXCLUDED.timestamp
+        """, list(latest.values()), page_size=INSERT_PAGE_SIZE)
+
+
+def metrics_row(url_id, metrics):
+    row = {name: getattr(metrics, name, None) for name in METRIC_COLUMNS}
+    row["url_id"] = url_id
+    links = broken_links_of(metrics)
+    row["broken_link_count"] = len(links) if links is not None else -1
+    row["timestamp"] = getattr(metrics, 'timestamp', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    # Clients without a group send None, which Metrics turns into -1
+    if not isinstance(row["group_id"], int) or row["group_id"] <= 0:
+        row["group_id"] = None
+    return tuple(row[name] for name in METRIC_COLUMNS)
+
+
+NOTIFY_PAYLOAD_BYTES = 7900  # pg_notify payloads must stay under 8000 bytes
+
+
+def publish_written_urls(cursor, url_ids):
+    # Delivered to listeners only when the transaction commits, so alerts never see unwritten rows
+    payload = ""
+    for url_id in sorted(set(url_ids)):
+        item = str(url_id)
+        if payload and len(payload) + len(item) + 1 > NOTIFY_PAYLOAD_BYTES:
+            cursor.execute("SELECT pg_notify(%s, %s)", (METRICS_CHANNEL, payload))
+            payload = ""
+        payload = f"{payload},{item}" if payload else item
+    if payload:
+        cursor.execute("SELECT pg_notify(%s, %s)", (METRICS_CHANNEL, payload))
+
+
+def write_metrics(cursor, items, notify=True):
+    # items: (url_id, Metrics) pairs; they are added to their rollup buckets in the same transaction.
+    # notify=False skips the metrics_ingested event, so notification crawlers don't evaluate the rows.
+    rows = [metrics_row(url_id, m) for url_id, m in items]
+    if rows:
+        execute_values(cursor, INSERT_METRICS_SQL, rows, page_size=INSERT_PAGE_SIZE)
+        update_rollups(cursor, [tuple(row[i] for i in ROLLUP_COLUMNS) for row in rows])
+        write_broken_links(cursor, items, [row[ROLLUP_KEY[3]] for row in rows])
+        write_latest_metrics(cursor, rows)
+        url, _, _, ts = ROLLUP_KEY
+        update_baselines(cursor, ((row[url], name, row[i], row[ts]) for row in rows for name, i in BASELINE_COLUMNS))
+        if notify:
+            publish_written_urls(cursor, (row[url] for row in rows))
+    return len(rows)
+
+
+def url_ids_for(cursor, urls):
+    urls = list(set(urls))
+    cursor.execute("INSERT INTO urls (url) SELECT unnest(%s::text[]) ON CONFLICT (url) DO NOTHING", (urls,))
+    cursor.execute("SELECT url, id FROM urls WHERE url = ANY(%s)", (urls,))
+    return dict(cursor.fetchall())
+
+
+def insert_metrics_batch(metrics_list):
+    # One connection and one transaction for a whole client batch
+    if not metrics_list:
+        return 0
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        ids = url_ids_for(cursor, [m.url for m in metrics_list])
+        count = write_metrics(cursor, [(ids[m.url], m) for m in metrics_list])
+        conn.commit()
+    return count
 
 
-def update_last_checked(url):
-    conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE urls SET last_checked = CURRENT_TIMESTAMP WHERE url = %s", (url,))
-    conn.commit()
-    conn.close()
+def insert_metrics(metrics):
+    insert_metrics_batch([metrics])
+
+
+def refresh_scheduler():
+    with get_db_conn() as conn:
+        return scheduler.refresh(conn.cursor())
+
+
+def count_lease(**amounts):
+    with lease_stats_lock:
+        for name, amount in amounts.items():
+            lease_stats[name] += amount
+
+
+def lease_url(client, url_id, group_id):
+    # Re-checks the scheduler's pick in the database; SKIP LOCKED makes a concurrent lease on it fail fast
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO url_group_schedule (url_id, group_id) SELECT id, %s FROM urls WHERE id = %s
+            ON CONFLICT DO NOTHING
+        """, (group_id, url_id))
+        cursor.execute("SELECT 1 FROM urls WHERE id = %s", (url_id,))
+        if not cursor.fetchone():
+            # Deleted since the scheduler loaded it; stop offering it
+            conn.rollback()
+            scheduler.remove(url_id)
+            return None
+        cursor.execute("""
+            SELECT u.url FROM url_group_schedule s
+            JOIN urls u ON u.id = s.url_id
+            WHERE s.url_id = %s AND s.group_id = %s
+              AND u.referenced > 0 AND u.forceInactive = 0
+              AND (s.lease_expires IS NULL OR s.lease_expires < CURRENT_TIMESTAMP)
+            FOR UPDATE OF s SKIP LOCKED
+        """, (url_id, group_id))
+        row = cursor.fetchone()
+        if not row:
+            conn.rollback()
+            return None
+        url = row[0]
+        cursor.execute("""
+            UPDATE url_leases SET status = 'expired', finished_at = CURRENT_TIMESTAMP
+            WHERE url_id = %s AND group_id = %s AND status = 'active'
+        """, (url_id, group_id))
+        if cursor.rowcount:
+            count_lease(expired=cursor.rowcount)
+        cursor.execute("""
+            INSERT INTO url_leases (url_id, group_id, client, expires_at)
+            VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+            RETURNING id
+        """, (url_id, group_id, client, LEASE_SECONDS))
+        lease_id = cursor.fetchone()[0]
+        cursor.execute("""
+            UPDATE url_group_schedule
+            SET lease_id = %s, lease_expires = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE url_id = %s AND group_id = %s
+        """, (lease_id, LEASE_SECONDS, url_id, group_id))
+        conn.commit()
+    count_lease(granted=1)
+    return lease_id, url_id, group_id, url
+
+
+def next_lease(client, group_id):
+    if not scheduler.has_group(group_id):
+        with get_db_conn() as conn:
+            scheduler.load_group(conn.cursor(), group_id)
+    candidate = scheduler.acquire(group_id)
+    if candidate is None:
+        return None
+    url_id = candidate[0]
+    try:
+        lease = lease_url(client, url_id, group_id)
+    except Exception:
+        scheduler.requeue(url_id, group_id)
+        raise
+    if lease is None:
+        # Leased elsewhere or deactivated since the last refresh (a deleted URL is already gone, so this is a no-op)
+        scheduler.requeue(url_id, group_id, delay=LEASE_POLL_INTERVAL)
+        return None
+    scheduler.assign(url_id, group_id, lease[0])
+    return lease
+
+
+def complete_leases(items):
+    # Metrics from every (lease, metrics_list) item, their lease records and last_checked stamps share one transaction
+    # Rows are keyed by the leased url_id, whatever URL string the client echoed back
+    all_metrics = [(lease[1], m) for lease, metrics_list in items for m in metrics_list]
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        write_metrics(cursor, all_metrics)
+        durations = execute_values(cursor, """
+            UPDATE url_leases SET status = 'completed', finished_at = CURRENT_TIMESTAMP, rows_ingested = v.rows
+            FROM (VALUES %s) AS v(id, rows)
+            WHERE url_leases.id = v.id
+            RETURNING url_leases.id, EXTRACT(EPOCH FROM finished_at - leased_at)
+        """, [(lease[0], len(metrics_list)) for lease, metrics_list in items], fetch=True)
+        execute_values(cursor, """
+            UPDATE url_group_schedule s SET last_checked = CURRENT_TIMESTAMP,
+                lease_expires = CASE WHEN s.lease_id = v.lease_id THEN NULL ELSE s.lease_expires END,
+                lease_id = CASE WHEN s.lease_id = v.lease_id THEN NULL ELSE s.lease_id END
+            FROM (VALUES %s) AS v(lease_id, url_id, group_id)
+            WHERE s.url_id = v.url_id AND s.group_id = v.group_id
+        """, [lease[:3] for lease, _ in items])
+        cursor.execute("UPDATE urls SET last_checked = CURRENT_TIMESTAMP WHERE id = ANY(%s)",
+                       (list({lease[1] for lease, _ in items}),))
+        conn.commit()
+    durations = {lease_id: float(seconds) for lease_id, seconds in durations}
+    results = {}
+    for lease, metrics_list in items:
+        lease_id, url_id, group_id, _ = lease
+        scheduler.complete(url_id, group_id, lease_id)
+        results[lease_id] = (len(metrics_list), durations.get(lease_id))
+    count_lease(completed=len(items), rows=len(all_metrics))
+    return results
+
+
+def release_lease(lease):
+    # Puts the URL straight back in its group's queue without touching last_checked
+    lease_id, url_id, group_id, _ = lease
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE url_leases SET status = 'released', finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'active'
+        """, (lease_id,))
+        cursor.execute("""
+            UPDATE url_group_schedule SET lease_id = NULL, lease_expires = NULL
+            WHERE url_id = %s AND group_id = %s AND lease_id = %s
+        """, (url_id, group_id, lease_id))
+        conn.commit()
+    scheduler.requeue(url_id, group_id, lease_id)
+    count_lease(released=1)
+
+
+def maintain_partitions():
+    # Creates upcoming metrics partitions and applies the retention policy from config
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        created = ensure_metrics_partitions(cursor)
+        expired = apply_metrics_retention(cursor)
+        conn.commit()
+    if created:
+        print(f"[PARTITION] Created {', '.join(created)}")
+    if expired:
+        print(f"[PARTITION] Retention removed {', '.join(expired)}")
+
+
+def close_rollup_buckets():
+    with get_db_conn() as conn:
+        closed = close_rollups(conn.cursor())
+    if closed:
+        print(f"[ROLLUP] Closed {len(closed)} bucket(s)")
+
+
+def requeue_expired_leases():
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE url_leases SET status = 'expired', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'active' AND expires_at < CURRENT_TIMESTAMP
+            RETURNING id, url_id, group_id
+        """)
+        expired = cursor.fetchall()
+        cursor.execute("""
+            UPDATE url_group_schedule SET lease_id = NULL, lease_expires = NULL
+            WHERE lease_expires < CURRENT_TIMESTAMP
+        """)
+        conn.commit()
+    for lease_id, url_id, group_id in expired:
+        scheduler.requeue(url_id, group_id, lease_id)
+    if expired:
+        count_lease(expired=len(expired))
+        with lease_stats_lock:
+            stats = dict(lease_stats)
+        print(f"[LEASE] Requeued {len(expired)} expired lease(s). Stats: {stats}")
 
 
 def resolve_final_url(input_url):
@@ -130,132 +468,351 @@ def resolve_final_url(input_url):
         return None
 
 
-def handle_client(conn, addr, dynamic_port):
-    client_socket = DynamicClientSocket(conn)
-    print(f"Sent dynamic port {dynamic_port} to client {addr}")
+def collect_metrics(obj, all_metrics):
+    if isinstance(obj, list):
+        for m in obj:
+            if isinstance(m, dict):
+                m = Metrics.from_dict(m)
+            if not hasattr(m, 'url'):
+                print(f"Invalid object in list: {type(m)} - {m}")
+                continue
+            all_metrics.append(m)
+        return True
+    if hasattr(obj, 'url'):
+        all_metrics.append(obj)
+        return True
+    print(f"Invalid object received: {type(obj)} - {obj}")
+    return False
+
+
+async def run_db(fn, *args):
+    # Blocking psycopg2 work runs on a bounded executor sized to the connection pool
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(fn, *args))
+
+
+async def wait_for_shutdown(timeout):
     try:
+        await asyncio.wait_for(shutdown_event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+def track(coro, tasks):
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+async def confirm_durable(client_socket, client_name, durable, lease_id, url_id, group_id, url):
+    try:
+        count, duration = await durable
+    except Exception as e:
+        # Not written: put the URL back in its group's queue and tell the client
+        print(f"[INGEST] Lease #{lease_id} {url} from {client_name} was not stored: {e}")
+        await run_db(release_lease, (lease_id, url_id, group_id, url))
+        ack = {"ack": lease_id, "url": url, "stored": False}
+    else:
+        print(f"[LEASE] #{lease_id} {url} completed by {client_name}: {count} rows in {duration or 0:.1f}s")
+        ack = {"ack": lease_id, "url": url, "stored": True, "rows": count}
+    try:
+        await client_socket.send(ack)
+    except (ConnectionError, OSError):
+        pass
+
+
+def ingestion_overloaded():
+    return ingestion is not None and ingestion.pending_bytes >= MAX_PENDING_INGEST_BYTES
+
+
+def admit_session():
+    # Sessions count from the handshake, so a reconnect burst cannot overshoot while ports are open
+    if session_stats["connected"] + admission_stats["reserved_sessions"] >= MAX_SESSIONS or ingestion_overloaded():
+        admission_stats["rejected_sessions"] += 1
+        return False
+    admission_stats["reserved_sessions"] += 1
+    return True
+
+
+def admit_assignment():
+    if admission_stats["inflight"] >= MAX_INFLIGHT_ASSIGNMENTS or ingestion_overloaded():
+        admission_stats["deferred_assignments"] += 1
+        return False
+    admission_stats["inflight"] += 1
+    return True
+
+
+async def handle_client(client_socket):
+    addr = client_socket.peername()
+    client_name = f"{addr[0]}:{addr[1]}"
+    session_stats["connected"] += 1
+    session_stats["peak_connected"] = max(session_stats["peak_connected"], session_stats["connected"])
+    lease = None
+    try:
+        # Clients introduce themselves with their group so each group covers every URL on its own
+        try:
+            hello = await asyncio.wait_for(client_socket.receive(), HELLO_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"[!] Client {client_name} sent no hello within {HELLO_TIMEOUT}s; closing.")
+            return
+        if hello is None:
+            return
+        group_id = hello.get("group_id") if isinstance(hello, dict) else None
+        group_id = group_id if isinstance(group_id, int) and group_id > 0 else NO_GROUP
+        print(f"Client {client_name} joined group {group_id or 'none'}")
+
         while not shutdown_event.is_set():
-            url = get_oldest_url()
-            if not url:
-                print("No URLs in database. Add some via the dashboard.")
-                client_socket.send("exit")
-                break
+            if not admit_assignment():
+                await client_socket.send({"retry_after": RETRY_AFTER_SECONDS})
+                await wait_for_shutdown(RETRY_AFTER_SECONDS)
+                continue
+            try:
+                lease = await run_db(next_lease, client_name, group_id)
+            finally:
+                if not lease:
+                    admission_stats["inflight"] -= 1
+            if not lease:
+                if not scheduler.active_count():
+                    print("No URLs in database. Add some via the dashboard.")
+                    await client_socket.send("exit")
+                    break
+                # Nothing is due yet; hold the client until something is
+                wait = scheduler.seconds_until_due(group_id)
+                await wait_for_shutdown(min(wait if wait is not None else LEASE_POLL_INTERVAL, LEASE_POLL_INTERVAL))
+                continue
 
-            client_socket.send(url)
+            lease_id, url_id, group_id, url = lease
+            await client_socket.send(url)
+            session_stats["assignments"] += 1
+            received_before = client_socket.bytes_received
 
             all_metrics = []
-
             while True:
-                obj = client_socket.receive()
+                obj = await client_socket.receive()
                 if obj == "DONE":
-                    print("Received 'DONE' from client.")
                     break
                 if obj is None:
                     print("Received None object.")
                     return
-                if isinstance(obj, list):
-                    for m in obj:
-                        if isinstance(m, dict):
-                            m = Metrics.from_dict(m)
-                        if not hasattr(m, 'url'):
-                            print(f"Invalid object in list: {type(m)} - {m}")
-                            continue
-                        all_metrics.append(m)
-                elif hasattr(obj, 'url'):
-                    all_metrics.append(obj)
-                else:
-                    print(f"Invalid object received: {type(obj)} - {obj}")
+                if not collect_metrics(obj, all_metrics):
                     return
 
-            for metrics in all_metrics:
-                insert_metrics(metrics)
-
-            print(f"Inserted metrics for {url}. Waiting for 'DONE' signal...")
-            update_last_checked(url)
-            print(f"Updated last checked for {url}")
+            # The write happens behind the session; the next URL goes out without waiting for the database.
+            # The lease stays ours to release until the ingestion queue has accepted it.
+            durable = await ingestion.put(lease, all_metrics, client_socket.bytes_received - received_before)
+            lease = None
+            admission_stats["inflight"] -= 1
+            track(confirm_durable(client_socket, client_name, durable, lease_id, url_id, group_id, url), ack_tasks)
+    except Exception as e:
+        print(f"[!] Client {client_name} error: {e}")
     finally:
-        conn.close()
-        print(f"[Thread Exit] Client thread for {addr} exiting.")
+        session_stats["connected"] -= 1
+        try:
+            if lease:
+                admission_stats["inflight"] -= 1
+                await run_db(release_lease, lease)
+                print(f"[LEASE] #{lease[0]} {lease[3]} released by {client_name}")
+        finally:
+            client_socket.close()
+            print(f"[Session Exit] Client session for {client_name} ended.")
 
 
-def console_listener():
+def console_listener(loop):
     while not shutdown_event.is_set():
-        command = input()
+        try:
+            command = input()
+        except EOFError:
+            break
         if command.strip().lower() in ("exit", "shutdown"):
             print("Shutdown command received.")
-            shutdown_event.set()
+            loop.call_soon_threadsafe(shutdown_event.set)
+            break
     print("[Thread Exit] Console listener thread exiting.")
 
 
-def accept_dynamic_client(dynamic_socket, dynamic_port):
-    try:
-        conn, addr = dynamic_socket.accept()
-        print(f"[+] Client connected on dynamic port {dynamic_port} from {addr}")
-        handle_client(conn, addr, dynamic_port)
-    except Exception as e:
-        print(f"[!] Error accepting client on port {dynamic_port}: {e}")
-    finally:
-        dynamic_socket.close()
-        print(f"[Thread Exit] accept_dynamic_client thread for port {dynamic_port} exiting.")
-
-
-def start_server():
-    initialize_databases()
-    validate_server_role()
-    console_thread = threading.Thread(target=console_listener)
-    console_thread.start()
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as handshake_socket:
-        handshake_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        handshake_socket.bind((HOST, PERMANENT_PORT))
-        handshake_socket.listen()
-        handshake_socket.settimeout(1.0)
-
-        print(f"Server started. Handshake listener on {HOST}:{PERMANENT_PORT}")
+async def open_dynamic_listener():
+    # One-shot listener per handshake: the first connection becomes a client session, then it closes
+    connected = asyncio.Event()
 
+    async def on_connect(reader, writer):
+        if connected.is_set():
+            writer.close()
+            return
+        connected.set()
+        admission_stats["reserved_sessions"] -= 1
+        dynamic_server.close()
+        task = asyncio.current_task()
+        client_tasks.add(task)
         try:
-            while not shutdown_event.is_set():
-                try:
-                    handshake_conn, handshake_addr = handshake_socket.accept()
-                except socket.timeout:
-                    continue
-
-                if shutdown_event.is_set():
-                    handshake_conn.close()
-                    break
+            await handle_client(AsyncJsonSocket(reader, writer, session_stats))
+        finally:
+            client_tasks.discard(task)
 
-                print(f"[+] Handshake from {handshake_addr}")
-                handshake = HandshakeSocket(handshake_conn)
+    dynamic_server = await asyncio.start_server(on_connect, HOST, 0, limit=MAX_MESSAGE_BYTES)
+    dynamic_port = dynamic_server.sockets[0].getsockname()[1]
 
-                dynamic_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                dynamic_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                dynamic_socket.bind((HOST, 0))
-                dynamic_port = dynamic_socket.getsockname()[1]
-                dynamic_socket.listen()
+    async def expire():
+        await asyncio.sleep(DYNAMIC_ACCEPT_TIMEOUT)
+        if not connected.is_set():
+            connected.set()
+            admission_stats["reserved_sessions"] -= 1
+            dynamic_server.close()
+            print(f"[!] No client connected on dynamic port {dynamic_port}; closed.")
 
-                handshake.send(dynamic_port)
-                handshake.close()
+    track(expire(), background_tasks)
+    return dynamic_port
 
-                client_thread = threading.Thread(
-                    target=accept_dynamic_client,
-                    args=(dynamic_socket, dynamic_port)
-                )
-                client_thread.start()
-                clients_threads.append(client_thread)
 
+async def handle_handshake(reader, writer):
+    handshake = AsyncJsonSocket(reader, writer)
+    print(f"[+] Handshake from {handshake.peername()}")
+    try:
+        if shutdown_event.is_set():
+            return
+        if not admit_session():
+            await handshake.send({"retry_after": RETRY_AFTER_SECONDS})
+            return
+        try:
+            dynamic_port = await open_dynamic_listener()
+        except Exception:
+            admission_stats["reserved_sessions"] -= 1
+            raise
+        await handshake.send(dynamic_port)
+    except (ConnectionError, OSError) as e:
+        print(f"[!] Handshake error: {e}")
+    finally:
+        handshake.close()
+
+
+def collect_server_metrics():
+    pool = db_pool_stats()
+    with lease_stats_lock:
+        leases = dict(lease_stats)
+    families = [
+        ("monitor_connected_clients", "gauge", "Client sessions currently connected.",
+         [({}, session_stats["connected"])]),
+        ("monitor_connected_clients_peak", "gauge", "Most client sessions connected at once.",
+         [({}, session_stats["peak_connected"])]),
+        ("monitor_assignments_total", "counter", "URLs handed out to clients.",
+         [({}, session_stats["assignments"])]),
+        ("monitor_assignments_per_second", "gauge", "URLs handed out per second over the last minute.",
+         [({}, round(assignment_rate.rate(), 3))]),
+        ("monitor_bytes_received_total", "counter", "Bytes received from client sessions.",
+         [({}, session_stats["bytes_received"])]),
+        ("monitor_bytes_received_per_second", "gauge", "Bytes received per second over the last minute.",
+         [({}, round(bytes_rate.rate(), 3))]),
+        ("monitor_ingest_queue_rows", "gauge", "Metric rows waiting for or being written to the database.",
+         [({}, ingestion.depth() if ingestion else 0)]),
+        ("monitor_ingest_backpressure_waits_total", "counter", "Times a session waited for ingestion queue space.",
+         [({}, ingestion.stats["backpressure_waits"] if ingestion else 0)]),
+        ("monitor_ingest_failed_batches_total", "counter", "Client batches that could not be stored.",
+         [({}, ingestion.stats["failed_batches"] if ingestion else 0)]),
+        ("monitor_inflight_assignments", "gauge", "URLs sent to clients whose results have not arrived yet.",
+         [({}, admission_stats["inflight"])]),
+        ("monitor_ingest_queue_bytes", "gauge", "Client payload bytes waiting for or being written to the database.",
+         [({}, ingestion.pending_bytes if ingestion else 0)]),
+        ("monitor_admission_rejections_total", "counter", "Clients told to retry later, by stage.",
+         [({"stage": "session"}, admission_stats["rejected_sessions"]),
+          ({"stage": "assignment"}, admission_stats["deferred_assignments"])]),
+        ("monitor_insert_latency_seconds", "histogram", "Time to write one ingestion flush to the database.",
+         insert_latency),
+        ("monitor_leases_total", "counter", "Lease outcomes since start.",
+         [({"outcome": name}, value) for name, value in leases.items() if name != "rows"]),
+        ("monitor_db_pool_connections", "gauge", "Database pool connections by state.",
+         [({"state": state}, pool[state]) for state in ("in_use", "idle", "size", "max")]),
+        ("monitor_db_pool_waits_total", "counter", "Checkouts that had to wait for a free connection.",
+         [({}, pool["waits"])]),
+        ("monitor_db_pool_wait_seconds_total", "counter", "Time spent waiting for a free connection.",
+         [({}, round(pool["wait_seconds"], 6))]),
+        ("monitor_db_pool_timeouts_total", "counter", "Checkouts that gave up waiting for a connection.",
+         [({}, pool["timeouts"])]),
+        ("monitor_db_statements_total", "counter", "Statements sent through pooled connections.",
+         [({}, pool["statements"])]),
+        ("monitor_url_staleness_seconds", "gauge", "Seconds since each active URL was last measured, per client group.",
+         [({"url": url, "group": group_id}, round(age, 1))
+          for url, group_id, age in scheduler.staleness() if age is not None]),
+    ]
+    return families
+
+
+def sample_rates():
+    assignment_rate.sample(session_stats["assignments"])
+    bytes_rate.sample(session_stats["bytes_received"])
+
+
+async def maintenance_loop():
+    last_sweep = time.monotonic()
+    last_partitioning = None
+    last_close = None
+    while not shutdown_event.is_set():
+        await wait_for_shutdown(SCHEDULER_REFRESH_INTERVAL)
+        sample_rates()
+        try:
+            await run_db(refresh_scheduler)
+            if time.monotonic() - last_sweep >= LEASE_SWEEP_INTERVAL:
+                await run_db(requeue_expired_leases)
+                last_sweep = time.monotonic()
+            if last_partitioning is None or time.monotonic() - last_partitioning >= PARTITION_MAINTENANCE_INTERVAL:
+                last_partitioning = time.monotonic()
+                await run_db(maintain_partitions)
+            if last_close is None or time.monotonic() - last_close >= ROLLUP_CLOSE_INTERVAL:
+                last_close = time.monotonic()
+                await run_db(close_rollup_buckets)
         except Exception as e:
-            print(f"[!] Handshake loop error: {e}")
-
-        print("Waiting for all client threads to finish...")
-        for i, thread in enumerate(clients_threads):
-            print(f"Waiting on client thread #{i}")
-            thread.join()
-            print(f"Client thread #{i} joined.")
-
-        print("All client threads finished.")
-        console_thread.join()
-        print("Console thread finished.")
-        print("Server shut down cleanly.")
+            print(f"[!] Maintenance error: {e}")
+
+
+async def serve():
+    global ingestion
+    loop = asyncio.get_running_loop()
+    ingestion = IngestionQueue(complete_leases, db_executor, max_rows=INGEST_MAX_ROWS,
+                               flush_rows=INGEST_FLUSH_ROWS, flush_seconds=INGEST_FLUSH_SECONDS,
+                               latency=insert_latency, max_bytes=MAX_PENDING_INGEST_BYTES)
+    threading.Thread(target=console_listener, args=(loop,), daemon=True).start()
+
+    handshake_server = await asyncio.start_server(handle_handshake, HOST, PERMANENT_PORT,
+                                                  reuse_address=True, backlog=HANDSHAKE_BACKLOG)
+    print(f"Server started. Handshake listener on {HOST}:{PERMANENT_PORT}")
+    metrics_server = None
+    if METRICS_PORT:
+        registry = MetricsRegistry()
+        registry.register(collect_server_metrics)
+        metrics_server = await start_metrics_server(registry, METRICS_HOST, METRICS_PORT)
+        print(f"Metrics endpoint on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    sample_rates()
+    maintenance = asyncio.create_task(maintenance_loop())
+    flusher = asyncio.create_task(ingestion.run())
+
+    await shutdown_event.wait()
+    handshake_server.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    await handshake_server.wait_closed()
+
+    print(f"Waiting for {len(client_tasks)} client session(s) to finish...")
+    if client_tasks:
+        done, pending = await asyncio.wait(set(client_tasks), timeout=SHUTDOWN_GRACE_SECONDS)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await ingestion.close()
+    await flusher
+    if ack_tasks:
+        await asyncio.wait(set(ack_tasks), timeout=SHUTDOWN_GRACE_SECONDS)
+    for task in list(background_tasks):
+        task.cancel()
+    await maintenance
+    print(f"All client sessions finished. Stats: {session_stats}")
+
+
+def start_server():
+    initialize_databases()
+    validate_server_role()
+    requeue_expired_leases()
+    print(f"Scheduler loaded {refresh_scheduler()} URLs.")
+    asyncio.run(serve())
+    db_executor.shutdown()
+    print("Server shut down cleanly.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+from anomaly import MIN_HISTORY, rule_window, right_align, score_series
+
+
+def score(notif_type, history, latest, threshold, window):
+    values = right_align([history + [latest]], len(history) + 1)
+    fired, scores = score_series([notif_type], values, [threshold], [rule_window(notif_type, window)])
+    return bool(fired[0]), scores[0]
+
+
+class ScoreSeriesTest(unittest.TestCase):
+    def test_flat_history_does_not_fire(self):
+        for notif_type in ("zscore", "ewma"):
+            fired, value = score(notif_type, [100] * 20, 101, 3, 20)
+            self.assertFalse(fired, notif_type)
+            self.assertTrue(np.isnan(value), notif_type)
+
+    def test_spike_fires(self):
+        history = [100, 102, 98, 101, 99] * 4
+        for notif_type in ("zscore", "ewma"):
+            self.assertTrue(score(notif_type, history, 150, 3, 20)[0], notif_type)
+
+    def test_short_window_is_raised_to_min_history(self):
+        self.assertEqual(rule_window("zscore", 3), MIN_HISTORY)
+        self.assertEqual(rule_window("consecutive", 2), 2)
+        self.assertTrue(score("zscore", [10, 11, 9, 10, 11, 9], 500, 3, 3)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()